@@ -4,6 +4,7 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException
 import pandas as pd
 import requests
 from bs4 import BeautifulSoup
@@ -13,10 +14,46 @@ from datetime import datetime
 import logging
 import re
 import socket
+import json
+import sqlite3
+import hashlib
+import html
+import importlib.util
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, urljoin, unquote
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
-from queue import Queue
-from threading import Lock
+from queue import Queue, Empty
+from threading import Lock, Thread, Event, BoundedSemaphore, local
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import sys
+import tempfile
+import argparse
+import glob
+import subprocess
+import zlib
+try:
+    import psutil  # Optional, only used to report Chrome memory in the browser mode comparison
+except ImportError:
+    psutil = None
+try:
+    from PIL import Image  # Optional, only needed when thumbnails are enabled
+except ImportError:
+    Image = None
+try:
+    import resource  # Peak RSS over the process lifetime; not available on Windows
+except ImportError:
+    resource = None
+try:
+    import pyarrow as pa  # Optional, only needed for the Parquet export
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+try:
+    import xlsxwriter  # Optional, preferred over openpyxl for the Excel export
+except ImportError:
+    xlsxwriter = None
 
 # Step 1: Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -26,57 +63,303 @@ def is_port_available(port):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         return s.connect_ex(('localhost', port)) != 0
 
-# Step 3: Find an available port
+# Step 3: Find an available port (ports already handed to another pool driver are skipped)
+reserved_ports = set()
+port_lock = Lock()
+
 def find_available_port(start_port=9515):
-    port = start_port
-    while not is_port_available(port):
-        port += 1
-        if port > start_port + 100:  # Limit search to avoid infinite loop
-            raise Exception("No available ports found in range")
-    return port
+    with port_lock:
+        port = start_port
+        while port in reserved_ports or not is_port_available(port):
+            port += 1
+            if port > start_port + 100:  # Limit search to avoid infinite loop
+                raise Exception("No available ports found in range")
+        reserved_ports.add(port)  # Reserve until the driver on it quits, so parallel starts never collide
+        return port
+
+def release_port(port):
+    with port_lock:
+        reserved_ports.discard(port)
 
 # Step 4: Configure requests with a large connection pool and retries
 session = requests.Session()
-retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+# Only server errors are retried here; connect/read timeouts go to the per-host circuit breaker instead of stacking
+retries = Retry(total=3, connect=0, read=0, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
 adapter = HTTPAdapter(max_retries=retries, pool_maxsize=100, pool_connections=100)
 session.mount('http://', adapter)
 session.mount('https://', adapter)
 
-# Step 5: Global lock and queue for managing requests
-request_queue = Queue(maxsize=50)
-request_lock = Lock()
+# Step 5: Concurrency limit for outgoing requests and the background enrichment workers
+request_limiter = BoundedSemaphore(50)  # At most 50 website/image requests in flight across all threads
+enrichment_workers = 16  # Threads filling in email, socials and images while the browsers keep scraping
+enrichment_executor = ThreadPoolExecutor(max_workers=enrichment_workers, thread_name_prefix="enrich")
+image_workers = 8  # Concurrent image downloads, kept separate so slow websites never hold up images
+image_executor = ThreadPoolExecutor(max_workers=image_workers, thread_name_prefix="image")
+
+# Step 6: Counters and latency histograms per stage, city and category, served in Prometheus text format
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Histogram upper bounds in seconds
+metrics_port = None  # Serve /metrics on 127.0.0.1:<port> while scraping (--metrics-port); None disables it
+metrics_summary_path = "metrics_summary.json"  # Per-stage totals written at shutdown
+
+def prometheus_labels(**labels):
+    escaped = {name: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for name, value in labels.items()}
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped.items()) + "}"
 
-# Step 6: Set up Selenium with ChromeDriver (dynamic port)
+class Metrics:
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or latency_buckets)
+        self.lock = Lock()
+        self.context = local()  # City and category of the task the current thread is working on
+        self.histograms = {}  # (stage, city, category) -> {"buckets": [...], "count", "sum", "max", "errors", "timeouts"}
+        self.events = {}  # (event, city, category) -> count
+        self.started = time.time()
+
+    def set_labels(self, city="", category=""):
+        self.context.labels = (city, category)
+
+    def labels(self, city=None, category=None):
+        default_city, default_category = getattr(self.context, "labels", ("", ""))
+        return city if city is not None else default_city, category if category is not None else default_category
+
+    def count(self, event, value=1, city=None, category=None):
+        key = (event, *self.labels(city, category))
+        with self.lock:
+            self.events[key] = self.events.get(key, 0) + value
+
+    def observe(self, stage, seconds, status="ok", city=None, category=None):
+        key = (stage, *self.labels(city, category))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0,
+                                                    "max": 0.0, "errors": 0, "timeouts": 0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+                    break
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+            if status != "ok":
+                histogram[f"{status}s"] += 1
+
+    @contextmanager
+    def timed(self, stage, city=None, category=None):
+        # Exceptions still propagate; they are only counted as the stage's errors or timeouts
+        start = time.perf_counter()
+        status = "error"
+        try:
+            yield
+            status = "ok"
+        except TimeoutException:
+            status = "timeout"
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start, status, city, category)
+
+    def prometheus(self):
+        with self.lock:
+            histograms = {key: dict(value, buckets=list(value["buckets"])) for key, value in self.histograms.items()}
+            events = dict(self.events)
+        lines = ["# HELP scraper_stage_seconds Latency of each scraping stage",
+                 "# TYPE scraper_stage_seconds histogram"]
+        for (stage, city, category), histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, histogram["buckets"]):
+                cumulative += bucket
+                lines.append(f"scraper_stage_seconds_bucket{prometheus_labels(stage=stage, city=city, category=category, le=bound)} {cumulative}")
+            lines.append(f"scraper_stage_seconds_bucket{prometheus_labels(stage=stage, city=city, category=category, le='+Inf')} {histogram['count']}")
+            lines.append(f"scraper_stage_seconds_sum{prometheus_labels(stage=stage, city=city, category=category)} {histogram['sum']:.6f}")
+            lines.append(f"scraper_stage_seconds_count{prometheus_labels(stage=stage, city=city, category=category)} {histogram['count']}")
+        lines += ["# HELP scraper_stage_failures_total Stage runs that raised, by kind",
+                  "# TYPE scraper_stage_failures_total counter"]
+        for (stage, city, category), histogram in sorted(histograms.items()):
+            for status in ("error", "timeout"):
+                lines.append(f"scraper_stage_failures_total{prometheus_labels(stage=stage, city=city, category=category, status=status)} {histogram[status + 's']}")
+        lines += ["# HELP scraper_events_total Businesses, duplicates and tasks counted while scraping",
+                  "# TYPE scraper_events_total counter"]
+        for (event, city, category), value in sorted(events.items()):
+            lines.append(f"scraper_events_total{prometheus_labels(event=event, city=city, category=category)} {value}")
+        lines.append(f"scraper_uptime_seconds {time.time() - self.started:.3f}")
+        return "\n".join(lines) + "\n"
+
+    def percentile(self, histogram, fraction):
+        # Upper bound of the bucket holding the percentile; the observed max when it falls past the last bucket
+        target = histogram["count"] * fraction
+        cumulative = 0
+        for bound, bucket in zip(self.buckets, histogram["buckets"]):
+            cumulative += bucket
+            if cumulative >= target:
+                return min(bound, histogram["max"])
+        return histogram["max"]
+
+    def summary(self):
+        with self.lock:
+            stages = {}
+            for (stage, city, category), histogram in self.histograms.items():
+                total = stages.setdefault(stage, {"count": 0, "sum": 0.0, "max": 0.0, "errors": 0, "timeouts": 0,
+                                                  "buckets": [0] * len(self.buckets)})
+                for field in ("count", "sum", "errors", "timeouts"):
+                    total[field] += histogram[field]
+                total["max"] = max(total["max"], histogram["max"])
+                total["buckets"] = [a + b for a, b in zip(total["buckets"], histogram["buckets"])]
+            events = {}
+            for (event, city, category), value in self.events.items():
+                events[event] = events.get(event, 0) + value
+        busy = sum(total["sum"] for total in stages.values()) or 1
+        return {
+            "wall_seconds": round(time.time() - self.started, 1),
+            "events": events,
+            "stages": {stage: {"count": total["count"], "errors": total["errors"], "timeouts": total["timeouts"],
+                               "busy_seconds": round(total["sum"], 2),  # Summed across threads, so it can exceed wall time
+                               "share": round(total["sum"] / busy, 3),
+                               "mean_ms": round(1000 * total["sum"] / total["count"], 1),
+                               "p95_ms": round(1000 * self.percentile(total, 0.95), 1),
+                               "max_ms": round(1000 * total["max"], 1)}
+                       for stage, total in sorted(stages.items(), key=lambda item: -item[1]["sum"])},
+        }
+
+    def save_summary(self, path=None):
+        path = path or metrics_summary_path
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
+        os.replace(temp_path, path)
+
+metrics = Metrics()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = metrics.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would drown the scraper's own log
+
+def start_metrics_server(port):
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Serving Prometheus metrics on http://127.0.0.1:{port}/metrics")
+    return server
+
+# Step 7: Set up Selenium with ChromeDriver options and driver pool settings
 chromedriver_path = r"E:\abdullah\chromedriver-win64\chromedriver.exe"  # Replace with your ChromeDriver path
-try:
-    port = find_available_port()
-    service = Service(chromedriver_path, port=port)
-except Exception as e:
-    logging.error(f"Error finding available port: {e}")
-    exit(1)
-
-options = webdriver.ChromeOptions()
-options.add_argument("--headless")  # Run in headless mode for efficiency
-options.add_argument("--no-sandbox")
-options.add_argument("--disable-dev-shm-usage")
-options.add_argument("--disable-blink-features=AutomationControlled")  # Avoid detection as bot
-options.add_argument("--window-size=1920,1080")  # Ensure larger viewport for scrolling
-
-# Step 7: Initialize driver with retry logic
-max_driver_attempts = 3
-driver = None
-for attempt in range(max_driver_attempts):
+pool_size = 4  # Number of headless Chrome instances scraping in parallel
+driver_max_tasks = 25  # Recycle a driver after this many tasks to limit memory growth
+max_task_restarts = 2  # How many times a task is re-queued after its driver crashed
+maps_url = "https://www.google.com/maps"
+
+# Lean mode (opt-in): only the DOM text and one image URL are read, so tiles, fonts, images and analytics are blocked
+lean_mode = False
+lean_blocked_urls = [
+    "*/maps/vt*", "*/kh/v=*", "*/maps/preview/log*",  # Map tiles, satellite imagery, Maps telemetry
+    "*fonts.gstatic.com/*", "*fonts.googleapis.com/*", "*.woff", "*.woff2", "*.ttf",
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.mp4",  # img src attributes stay readable
+    "*google-analytics.com/*", "*googletagmanager.com/*", "*doubleclick.net/*", "*/gen_204*", "*/csi?*",
+]
+
+def build_chrome_options(lean=False):
+    options = webdriver.ChromeOptions()
+    options.add_argument("--headless")  # Run in headless mode for efficiency
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_argument("--disable-blink-features=AutomationControlled")  # Avoid detection as bot
+    options.add_argument("--window-size=1920,1080")  # Ensure larger viewport for scrolling
+    if lean:
+        options.add_argument("--blink-settings=imagesEnabled=false")
+        options.add_argument("--disable-extensions")
+        options.add_argument("--disable-background-networking")
+        options.add_argument("--disable-component-update")
+        options.add_argument("--disable-sync")
+        options.add_argument("--mute-audio")
+        options.add_experimental_option("prefs", {
+            "profile.managed_default_content_settings.images": 2,
+            "profile.default_content_setting_values.notifications": 2,
+            "profile.default_content_setting_values.geolocation": 2,
+            "profile.default_content_setting_values.media_stream": 2,
+        })
+    return options
+
+def block_unneeded_requests(driver_instance):
+    # Request interception through DevTools; the results list and details pane XHRs are not matched
+    driver_instance.execute_cdp_cmd("Network.enable", {})
+    driver_instance.execute_cdp_cmd("Network.setBlockedURLs", {"urls": lean_blocked_urls})
+
+# Step 8: Start a driver on its own port with retry logic
+def start_driver(max_driver_attempts=3, lean=None):
+    lean = lean_mode if lean is None else lean
+    for attempt in range(max_driver_attempts):
+        port = None
+        try:
+            port = find_available_port()
+            # Without a driver at the configured path, Selenium Manager finds or downloads a matching one
+            service = Service(chromedriver_path if os.path.exists(chromedriver_path) else None, port=port)
+            driver_instance = webdriver.Chrome(service=service, options=build_chrome_options(lean))
+            if lean:
+                block_unneeded_requests(driver_instance)
+            return driver_instance, port
+        except Exception as e:
+            if port is not None:
+                release_port(port)
+            logging.error(f"Attempt {attempt + 1}/{max_driver_attempts} to start ChromeDriver failed: {e}")
+            time.sleep(5)
+    raise RuntimeError("Failed to initialize ChromeDriver after all attempts")
+
+# Step 9: Measure page-ready time, transferred bytes and memory of the normal and the lean browser mode
+page_transfer_script = """
+const entries = performance.getEntriesByType("navigation").concat(performance.getEntriesByType("resource"));
+return {requests: entries.length, bytes: entries.reduce((total, entry) => total + (entry.transferSize || 0), 0)};
+"""
+
+def chrome_rss(driver_instance):
+    if psutil is None:
+        return None
     try:
-        driver = webdriver.Chrome(service=service, options=options)
-        break
-    except Exception as e:
-        logging.error(f"Attempt {attempt + 1}/{max_driver_attempts} to start ChromeDriver failed: {e}")
-        time.sleep(5)
-if not driver:
-    logging.critical("Failed to initialize ChromeDriver after all attempts. Exiting.")
-    exit(1)
+        processes = psutil.Process(driver_instance.service.process.pid).children(recursive=True)
+        return sum(process.memory_info().rss for process in processes)
+    except Exception:
+        return None
+
+def measure_page_load(driver_instance, url):
+    driver_instance.execute_cdp_cmd("Performance.enable", {})
+    start = time.time()
+    driver_instance.get(url)
+    WebDriverWait(driver_instance, 60, poll_frequency=0.1).until(
+        EC.presence_of_element_located((By.CLASS_NAME, "hfpxzc")))  # Page is ready once result cards exist
+    ready = time.time() - start
+    transfer = driver_instance.execute_script(page_transfer_script)
+    metrics = {m["name"]: m["value"] for m in driver_instance.execute_cdp_cmd("Performance.getMetrics", {})["metrics"]}
+    return {"ready_seconds": ready, "requests": transfer["requests"], "bytes": transfer["bytes"],
+            "js_heap_bytes": metrics.get("JSHeapUsedSize", 0), "chrome_rss_bytes": chrome_rss(driver_instance)}
 
-# Step 8: Define all 12 cities with sample postal codes
+def compare_browser_modes(query="Bakery near 28001 Madrid Spain", runs=3):
+    url = f"{maps_url}/search/{query.replace(' ', '+')}"
+    results = {}
+    for lean in (False, True):
+        driver_instance, port = start_driver(lean=lean)
+        try:
+            samples = [measure_page_load(driver_instance, url) for _ in range(runs)]
+        finally:
+            driver_instance.quit()
+            release_port(port)
+        results["lean" if lean else "normal"] = {
+            name: (sum(sample[name] for sample in samples) / runs if samples[0][name] is not None else None)
+            for name in samples[0]}
+    for mode, result in results.items():
+        rss = f"{result['chrome_rss_bytes'] / 1024 ** 2:.0f} MB" if result["chrome_rss_bytes"] is not None else "n/a (install psutil)"
+        logging.info(f"{mode:>6}: ready {result['ready_seconds']:.2f}s, {result['requests']:.0f} requests, "
+                     f"{result['bytes'] / 1024:.0f} KB transferred, JS heap {result['js_heap_bytes'] / 1024 ** 2:.0f} MB, "
+                     f"Chrome RSS {rss}")
+    return results
+
+# Step 10: Define all 12 cities with sample postal codes
 cities = {
     "Madrid": "28001",
     "Barcelona": "08001",
@@ -92,7 +375,7 @@ cities = {
     "Bilbao": "48001"
 }
 
-# Step 9: Define all 200 categories (full list for starting from scratch)
+# Step 11: Define all 200 categories (full list for starting from scratch)
 categories = [
     "Butcher shop", "Natural products store", "Fishmonger", "Fruit shop", "Florist", "Jewelry", "Pastry shop",
     "Gourmet store", "Delicatessen", "Fruit juice bar", "Café", "Bakery", "Rope shop of fruits", "Zapatillas",
@@ -131,7 +414,7 @@ categories = [
     "Carpentry service", "Masonry service", "Tiling service", "Flooring service", "Insulation service", "Waterproofing service"
 ]
 
-# Step 10: Define output columns
+# Step 12: Define output columns
 columns = [
     "Category", "Business name", "Street", "Number", "Postal code", "City",
     "Phone 1", "Phone 2", "Mobile 1", "Mobile 2", "Mail", "Web url",
@@ -141,262 +424,968 @@ columns = [
     "Business hours Sunday", "Latitude", "Longitude", "Main image of the business"
 ]
 
-# Step 11: Initialize data list
-all_data = []
+# Step 13: Append-only checkpoint store; each finished (city, category) batch is written once and its task marked done
+checkpoint_path = "scrape_checkpoint.db"
+
+def open_checkpoint(path=None):
+    conn = sqlite3.connect(path or checkpoint_path)
+    conn.execute("PRAGMA journal_mode=WAL")  # Appends never rewrite earlier batches
+    conn.execute("""CREATE TABLE IF NOT EXISTS tasks (
+        city TEXT, category TEXT, rows INTEGER, finished_at TEXT, PRIMARY KEY (city, category))""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS records (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, city TEXT, category TEXT, data TEXT)""")
+    if "place_key" not in [row[1] for row in conn.execute("PRAGMA table_info(records)")]:
+        conn.execute("ALTER TABLE records ADD COLUMN place_key TEXT")  # Checkpoints written before the dedup index
+    conn.execute("CREATE INDEX IF NOT EXISTS records_place_key ON records (place_key)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS images (
+        place_key TEXT, city TEXT, category TEXT, business_name TEXT, sha256 TEXT, path TEXT, source_url TEXT,
+        PRIMARY KEY (place_key, sha256))""")
+    conn.commit()
+    return conn
+
+def save_batch(conn, city, category, records, complete=True):
+    # Snapshots, because on interruption an enrichment worker may still be adding keys to a record
+    records = [dict(record) for record in records]
+    with conn:  # One transaction, so a batch and its task marker are written together or not at all
+        conn.executemany("INSERT INTO records (city, category, place_key, data) VALUES (?, ?, ?, ?)",
+                         [(city, category, record.get("_place_key"), json.dumps(record, ensure_ascii=False))
+                          for record in records])
+        conn.executemany("INSERT OR IGNORE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         [(record.get("_place_key"), city, category, record["Business name"], record["_image_sha256"],
+                           record["Main image of the business"], record.get("_image_url"))
+                          for record in records if record.get("_image_sha256")])
+        if complete:
+            conn.execute("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?)",
+                         (city, category, len(records), datetime.now().isoformat(timespec="seconds")))
+
+def load_completed_tasks(conn):
+    return set(conn.execute("SELECT city, category FROM tasks"))
+
+def count_records(conn):
+    return conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+def iter_records(conn):
+    for (data,) in conn.execute("SELECT data FROM records ORDER BY id"):
+        yield json.loads(data)
+
+# Step 14: Index of places already scraped, so a business found again under another category only gains that category
+place_id_pattern = re.compile(r'!1s(0x[0-9a-f]+:0x[0-9a-f]+)')
+place_coords_pattern = re.compile(r'!3d(-?\d+\.\d+)!4d(-?\d+\.\d+)')
+
+def place_key(href, business_name, city):
+    href = href or ""
+    match = place_id_pattern.search(href)
+    if match:
+        return match.group(1)  # Maps feature ID, stable across searches
+    name = re.sub(r'\W+', ' ', (business_name or "").lower()).strip()
+    match = place_coords_pattern.search(href)
+    if match:
+        return f"{name}@{float(match.group(1)):.4f},{float(match.group(2)):.4f}"  # ~10 m grid
+    return f"{name}@{city.lower()}"
+
+class PlaceIndex:
+    def __init__(self, keys=()):
+        self.keys = set(keys)
+        self.pending_categories = []  # (place key, category) hits not yet written to the checkpoint
+        self.released = {}  # place key -> categories that hit it before its first sighting failed
+        self.lock = Lock()
+
+    @classmethod
+    def load(cls, conn):
+        return cls(key for (key,) in conn.execute("SELECT place_key FROM records WHERE place_key IS NOT NULL"))
+
+    def claim(self, key, category):
+        # True if the caller should scrape the place; otherwise the category is queued for the existing record
+        with self.lock:
+            if key not in self.keys:
+                self.keys.add(key)
+                # Categories parked by a failed earlier sighting attach to this one once it is checkpointed
+                self.pending_categories.extend((key, parked) for parked in self.released.pop(key, []) if parked != category)
+                return True
+            self.pending_categories.append((key, category))
+            return False
+
+    def release(self, key):
+        # The first sighting failed: its waiting category hits are parked until the next sighting claims the place
+        with self.lock:
+            self.keys.discard(key)
+            parked = [category for pending_key, category in self.pending_categories if pending_key == key]
+            self.pending_categories = [entry for entry in self.pending_categories if entry[0] != key]
+            self.released.setdefault(key, []).extend(parked)
+            return parked
+
+    def take_pending(self):
+        with self.lock:
+            pending, self.pending_categories = self.pending_categories, []
+        return pending
+
+    def requeue(self, pending):
+        with self.lock:
+            for key, category in pending:
+                if key in self.keys:
+                    self.pending_categories.append((key, category))
+                else:
+                    self.released.setdefault(key, []).append(category)  # Released while it was being attached
+
+def attach_pending_categories(conn, index):
+    unresolved = []
+    with conn:
+        for key, category in index.take_pending():
+            row = conn.execute("SELECT id, data FROM records WHERE place_key = ? ORDER BY id LIMIT 1", (key,)).fetchone()
+            if not row:
+                unresolved.append((key, category))  # The first sighting's batch is still being enriched
+                continue
+            record = json.loads(row[1])
+            record_categories = record["Category"].split("; ")
+            if category not in record_categories:
+                record["Category"] = "; ".join(record_categories + [category])
+                conn.execute("UPDATE records SET data = ? WHERE id = ?", (json.dumps(record, ensure_ascii=False), row[0]))
+    index.requeue(unresolved)
+
+# Step 15: On-disk HTTP cache with TTL, ETag/Last-Modified revalidation and a size-bounded LRU
+http_cache_dir = "http_cache"
+http_cache_ttl = 7 * 24 * 3600  # Serve entries younger than a week without contacting the site
+http_cache_max_bytes = 2 * 1024 ** 3  # Evict least recently used bodies beyond 2 GB
+http_cache = None  # Opened by main(); None disables caching
+
+def normalize_url(url):
+    parts = urlsplit(url.strip())
+    scheme, netloc = parts.scheme.lower(), parts.netloc.lower()
+    if (scheme, netloc.rpartition(":")[2]) in (("http", "80"), ("https", "443")):
+        netloc = netloc.rpartition(":")[0]
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))  # The fragment never reaches the server
+
+class HttpCache:
+    def __init__(self, folder=None, ttl=None, max_bytes=None):
+        self.folder = folder or http_cache_dir
+        self.ttl = http_cache_ttl if ttl is None else ttl
+        self.max_bytes = max_bytes or http_cache_max_bytes
+        os.makedirs(self.folder, exist_ok=True)
+        self.lock = Lock()
+        # Shard processes share this index, so readers must not block writers and a busy lock is waited out
+        self.conn = sqlite3.connect(os.path.join(self.folder, "index.db"), timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA busy_timeout=30000")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+            url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_type TEXT,
+            fetched_at REAL, accessed_at REAL, size INTEGER, result TEXT)""")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        self.hits = self.misses = self.revalidated = self.evicted = 0
+
+    def body_path(self, key):
+        return os.path.join(self.folder, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def get(self, key):
+        with self.lock:
+            try:
+                row = self.conn.execute("SELECT etag, last_modified, content_type, fetched_at, result FROM entries WHERE url = ?",
+                                        (key,)).fetchone()
+                if not row:
+                    return None
+                self.conn.execute("UPDATE entries SET accessed_at = ? WHERE url = ?", (time.time(), key))
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                logging.warning(f"HTTP cache lookup failed for {key}, treating it as a miss: {e}")
+                return None
+        etag, last_modified, content_type, fetched_at, result = row
+        return {"etag": etag, "last_modified": last_modified, "content_type": content_type,
+                "fresh": time.time() - fetched_at < self.ttl, "result": json.loads(result) if result else None,
+                "path": self.body_path(key)}
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def put(self, key, response, body, result=None):
+        path = self.body_path(key)
+        if body:  # Entries whose content is stored elsewhere (images) only keep headers and result
+            with open(path + ".tmp", "wb") as f:
+                f.write(body)
+            os.replace(path + ".tmp", path)
+        now = time.time()
+        with self.lock:
+            try:
+                self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                  (key, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                                   response.headers.get("Content-Type", ""), now, now, len(body),
+                                   json.dumps(result) if result is not None else None))
+                self.conn.commit()
+                self.evict()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                logging.warning(f"HTTP cache write failed for {key}: {e}")  # The fetched result is still used
+
+    def refresh(self, key):
+        # A 304 confirmed the stored body, so restart its TTL
+        with self.lock:
+            try:
+                self.conn.execute("UPDATE entries SET fetched_at = ? WHERE url = ?", (time.time(), key))
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                logging.warning(f"HTTP cache refresh failed for {key}: {e}")
+            self.revalidated += 1
+
+    def evict(self):
+        # Other shard processes write to the same cache, so the size is always read from the shared index
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute("SELECT url, size FROM entries ORDER BY accessed_at LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                try:
+                    os.remove(self.body_path(key))
+                except FileNotFoundError:
+                    pass
+                self.conn.execute("DELETE FROM entries WHERE url = ?", (key,))
+                self.total_bytes -= size
+                self.evicted += 1
+                if self.total_bytes <= self.max_bytes:
+                    break
+            self.conn.commit()
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "revalidated": self.revalidated,
+                "evicted": self.evicted, "bytes": self.total_bytes}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# Step 16: Per-host circuit breaker, persisted negative cache of dead hosts, and adaptive timeouts
+dead_hosts_path = "dead_hosts.json"
+host_failure_threshold = 3  # Consecutive connect/read timeouts before a host's circuit opens
+host_dns_failure_threshold = 2  # Consecutive DNS failures before a host is treated as gone (one can be a resolver hiccup)
+host_probe_timeout = 2 * 60  # A half-open probe that never reports back frees the slot after this many seconds
+host_circuit_cooldown = 15 * 60  # Seconds an open circuit rejects requests before one probe is let through
+dead_host_ttl = 3 * 24 * 3600  # How long an unreachable host stays in the negative cache
+host_timeout_bounds = (3, 30)  # Adaptive read timeout is clamped to this range in seconds
+host_connect_timeout = 10
+network_errors = (requests.exceptions.ConnectTimeout, requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError)
+
+def read_json_files(paths):
+    # Later (newer) files win, so the freshest entry from any shard is kept
+    merged = {}
+    for path in sorted(set(paths), key=lambda path: os.path.getmtime(path) if os.path.exists(path) else 0):
+        try:
+            with open(path, encoding="utf-8") as f:
+                merged.update(json.load(f))
+        except (FileNotFoundError, ValueError):
+            continue
+    return merged
+
+def is_dns_failure(error):
+    message = str(error)
+    return any(marker in message for marker in ("NameResolutionError", "Failed to resolve", "getaddrinfo failed",
+                                                "Name or service not known", "nodename nor servname"))
+
+class HostHealth:
+    def __init__(self):
+        self.path = None
+        self.lock = Lock()
+        self.failures = {}  # host -> consecutive failures
+        self.open_until = {}  # host -> time the open circuit lets a probe through
+        self.probing = {}  # host -> start time of the single half-open probe in flight
+        self.latency = {}  # host -> moving average of seconds until response headers
+        self.dead_hosts = {}  # host -> expiry time of its negative cache entry
+        self.skipped = 0
+
+    def load(self, path=None, shared=()):
+        # Other shards' files are read too, so every process starts from the hosts any of them found dead
+        self.path = path or dead_hosts_path
+        now = time.time()
+        merged = read_json_files([*shared, self.path])
+        self.dead_hosts = {host: expiry for host, expiry in merged.items() if expiry > now}
+        return self
+
+    def save(self):
+        if not self.path:
+            return
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.dead_hosts, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def allow(self, host):
+        now = time.time()
+        with self.lock:
+            if self.dead_hosts.get(host, 0) > now or self.open_until.get(host, 0) > now:
+                self.skipped += 1
+                return False
+            if host in self.open_until:
+                # Half-open: the cooldown is over, but only one request probes the host until it reports back
+                if now - self.probing.get(host, 0) < host_probe_timeout:
+                    self.skipped += 1
+                    return False
+                self.probing[host] = now
+            return True
+
+    def timeout(self, host):
+        average = self.latency.get(host)
+        if average is None:
+            return host_connect_timeout, host_timeout_bounds[1]
+        low, high = host_timeout_bounds
+        return host_connect_timeout, min(high, max(low, average * 4))
+
+    def record_success(self, host, elapsed):
+        with self.lock:
+            self.failures.pop(host, None)
+            self.open_until.pop(host, None)
+            self.probing.pop(host, None)
+            average = self.latency.get(host)
+            self.latency[host] = elapsed if average is None else 0.7 * average + 0.3 * elapsed
+
+    def record_failure(self, host, error):
+        now = time.time()
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            self.probing.pop(host, None)
+            dns_failure = is_dns_failure(error)
+            threshold = host_dns_failure_threshold if dns_failure else host_failure_threshold
+            if self.failures[host] < threshold:
+                return
+            self.open_until[host] = now + host_circuit_cooldown
+            logging.warning(f"Circuit opened for {host} after {self.failures[host]} failure(s): {error}")
+            # Slow hosts only get the cooldown; hosts that repeatedly don't resolve or accept connections are remembered
+            if not isinstance(error, requests.exceptions.ReadTimeout):
+                self.dead_hosts[host] = now + dead_host_ttl
+                self.save()
+
+    def stats(self):
+        return {"dead_hosts": len(self.dead_hosts), "open_circuits": sum(t > time.time() for t in self.open_until.values()),
+                "skipped_requests": self.skipped}
+
+host_health = HostHealth()  # In-memory until main() loads the persisted negative cache
+
+# Step 17: Stream images to disk under their SHA-256, so a photo seen under several categories is stored once
+images_dir = "images"
+image_max_bytes = 10 * 1024 ** 2  # Larger downloads are abandoned
+image_chunk_size = 64 * 1024
+thumbnail_size = None  # e.g. (320, 320) to also write images/thumbs/<hash>.jpg (needs Pillow)
+image_extensions = {"image/jpeg": "jpg", "image/png": "png", "image/webp": "webp", "image/gif": "gif"}
+
+def image_path(digest, extension):
+    return os.path.join(images_dir, digest[:2], f"{digest}.{extension}")
+
+def make_thumbnail(path, digest):
+    if not thumbnail_size or Image is None:
+        return None
+    thumb_path = os.path.join(images_dir, "thumbs", digest[:2], f"{digest}.jpg")
+    if not os.path.exists(thumb_path):
+        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+        with Image.open(path) as image:
+            image.thumbnail(thumbnail_size)
+            image.convert("RGB").save(thumb_path, "JPEG", quality=85)
+    return thumb_path
+
+def store_image(response):
+    # Hash while streaming to a temp file, then move it into place unless that hash is already stored
+    declared = int(response.headers.get("Content-Length") or 0)
+    if declared > image_max_bytes:
+        raise ValueError(f"image is {declared} bytes, over the {image_max_bytes} byte cap")
+    os.makedirs(images_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=images_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in response.iter_content(image_chunk_size):
+                size += len(chunk)
+                if size > image_max_bytes:
+                    raise ValueError(f"image exceeded the {image_max_bytes} byte cap")
+                digest.update(chunk)
+                f.write(chunk)
+        digest = digest.hexdigest()
+        extension = image_extensions.get(response.headers.get("Content-Type", "").split(";")[0].strip(), "jpg")
+        path = image_path(digest, extension)
+        if os.path.exists(path):
+            os.remove(temp_path)  # Same photo already stored for another business or category
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        return digest, path
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
-# Step 12: Function to download image with improved handling, retry logic, and queue management
 def download_image(url, business_name, category, city, max_retries=3):
+    # Returns (sha256, path) of the stored image, or None
     if not url or "http" not in url:
         logging.warning(f"No valid image URL for {business_name}")
         return None
-    folder = f"images_{city}"
-    os.makedirs(folder, exist_ok=True)
-    # Sanitize business name to remove or replace invalid characters
-    sanitized_name = re.sub(r'[\|/\\:<>*?"\']', '_', business_name)  # Replace special chars with underscore
-    sanitized_name = sanitized_name.replace(' ', '_')  # Ensure spaces are underscores
-    filename = f"{folder}/{category}_{sanitized_name}.jpg"
+    key = normalize_url(url)
+    entry = http_cache.get(key) if http_cache else None
+    if entry and entry["fresh"] and entry["result"] and os.path.exists(entry["result"]["path"]):
+        http_cache.count(hit=True)
+        return entry["result"]["sha256"], entry["result"]["path"]
+    host = urlsplit(url).hostname
     retries = 0
     while retries < max_retries:
+        if not host_health.allow(host):
+            logging.info(f"Skipping image for {business_name}: {host} is marked unreachable")
+            return None
         try:
-            with request_lock:
-                while request_queue.full():
-                    time.sleep(0.1)  # Very short wait to minimize delays
-                request_queue.put(1)
-            with session.get(url, timeout=30) as response:  # Increased timeout to 30 seconds
+            headers = http_cache.conditional_headers(entry) if entry and entry["result"] else {}
+            with request_limiter, session.get(url, timeout=host_health.timeout(host), headers=headers, stream=True) as response:
+                host_health.record_success(host, response.elapsed.total_seconds())
+                if response.status_code == 304 and headers and os.path.exists(entry["result"]["path"]):
+                    http_cache.refresh(key)
+                    http_cache.count(hit=True)
+                    return entry["result"]["sha256"], entry["result"]["path"]
                 if response.status_code == 200 and 'image' in response.headers.get('Content-Type', ''):
-                    with open(filename, 'wb') as f:
-                        f.write(response.content)
-                    logging.info(f"Downloaded image for {business_name} to {filename}")
-                    return filename
+                    digest, path = store_image(response)
+                    if http_cache:
+                        http_cache.count(hit=False)
+                        http_cache.put(key, response, b"", {"sha256": digest, "path": path})  # The body lives in images/
+                    try:
+                        make_thumbnail(path, digest)
+                    except Exception as e:  # e.g. SVG or truncated files Pillow can't read; the original is stored
+                        logging.warning(f"Could not make a thumbnail for {business_name} from {path}: {e}")
+                    logging.info(f"Downloaded image for {business_name} to {path}")
+                    return digest, path
                 else:
                     logging.warning(f"Failed to download {url}: Not an image or bad response ({response.status_code})")
+        except network_errors as e:
+            host_health.record_failure(host, e)
+            logging.error(f"Error downloading image for {business_name} (attempt {retries + 1}/{max_retries}): {e}")
+        except ValueError as e:
+            logging.warning(f"Skipping image for {business_name}: {e}")
+            return None
         except Exception as e:
             logging.error(f"Error downloading image for {business_name} (attempt {retries + 1}/{max_retries}): {e}")
-        finally:
-            with request_lock:
-                request_queue.get()
         retries += 1
         time.sleep(0.5)  # Reduced wait before retry for speed
     return None
 
-# Step 13: Function to scrape website for email and social media with queue management and timeout handling
+# Step 18: Function to scrape website for email and social media by streaming a capped body through precompiled regexes
+website_max_bytes = 512 * 1024  # Stop reading a page after this many bytes
+website_chunk_size = 16 * 1024
+contact_page_limit = 2  # Extra same-site pages (contact, legal notice) tried when the homepage has no email
+soup_parser = "lxml" if importlib.util.find_spec("lxml") else "html.parser"  # Only used by the fallback parse
+
+email_pattern = re.compile(rb'[\w.+-]+@[\w-]+(?:\.[\w-]+)*\.[a-z]{2,}', re.I)
+mailto_pattern = re.compile(rb'mailto:([\w.+-]+@[\w-]+(?:\.[\w-]+)*\.[a-z]{2,})', re.I)
+email_text_pattern = re.compile(r'[\w.+-]+\s*(?:@|\[at\]|\(at\))\s*[\w-]+(?:\.[\w-]+)*\.[a-z]{2,}', re.I)
+not_an_email_pattern = re.compile(rb'\.(?:png|jpe?g|gif|svg|webp|css|js)$', re.I)  # e.g. logo@2x.png
+# Only <a href> values count, so tracking pixels and SDK scripts in src attributes or inline JS are never taken
+social_patterns = {
+    "Instagram": re.compile(rb'href\s*=\s*["\']((?:https?:)?//(?:[\w-]+\.)?instagram\.com/[^"\'\s<>]*)["\']', re.I),
+    "Facebook": re.compile(rb'href\s*=\s*["\']((?:https?:)?//(?:[\w-]+\.)?facebook\.com/[^"\'\s<>]*)["\']', re.I),
+    "TikTok": re.compile(rb'href\s*=\s*["\']((?:https?:)?//(?:[\w-]+\.)?tiktok\.com/[^"\'\s<>]*)["\']', re.I),
+    "Linkedin": re.compile(rb'href\s*=\s*["\']((?:https?:)?//(?:[\w-]+\.)?linkedin\.com/[^"\'\s<>]*)["\']', re.I),
+}
+not_a_profile_pattern = re.compile(  # Share buttons, pixels, plugins and SDKs rather than the business's own page
+    rb'\.com/(?:tr|sharer(?:\.php)?|share(?:Article)?|plugins|dialog|embed|intent)(?:[/?.#]|$)|(?:embed|in|sdk)\.js', re.I)
+contact_link_pattern = re.compile(rb'href=["\']([^"\'#]*(?:contact|contacto|contactar|aviso-legal|legal|about|sobre)[^"\'#]*)["\']', re.I)
+
+class ContactScanner:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.email = ""
+        self.socials = {"Instagram": "", "Facebook": "", "TikTok": "", "Linkedin": ""}
+        self.contact_links = []
+        self.tail = b""
+
+    def complete(self):
+        return bool(self.email) and all(self.socials.values())
+
+    def feed(self, chunk, final=False):
+        data = self.tail + chunk
+        self.tail = data[-256:]  # Re-scan the overlap so matches split across chunks are still found
+        end = None if final else len(data)  # A match touching the end may continue in the next chunk
+        if not self.email:
+            match = mailto_pattern.search(data)
+            if match and match.end() != end:
+                self.email = match.group(1).decode("ascii", "ignore")
+            else:
+                for match in email_pattern.finditer(data):
+                    if match.end() != end and not not_an_email_pattern.search(match.group()):
+                        self.email = match.group().decode("ascii", "ignore")
+                        break
+        for name, pattern in social_patterns.items():
+            if not self.socials[name]:
+                for match in pattern.finditer(data):
+                    if match.end() != end and not not_a_profile_pattern.search(match.group(1)):
+                        self.socials[name] = html.unescape(match.group(1).decode("utf-8", "ignore")).lower()
+                        break
+        if len(self.contact_links) < contact_page_limit:
+            host = urlsplit(self.base_url).hostname
+            for match in contact_link_pattern.finditer(data):
+                link = urljoin(self.base_url, html.unescape(match.group(1).decode("utf-8", "ignore")))
+                if urlsplit(link).hostname == host and link not in self.contact_links:
+                    self.contact_links.append(link)
+
+    def parse_fallback(self, body):
+        # Emails hidden behind entities or split across tags only show up in the parsed text
+        text = BeautifulSoup(body, soup_parser).get_text(" ")
+        match = email_text_pattern.search(html.unescape(text))
+        if match:
+            self.email = re.sub(r'\s*(?:\[at\]|\(at\))\s*|\s*@\s*', '@', match.group(), flags=re.I)
+
+def read_capped(response, scanner):
+    body = bytearray()
+    for chunk in response.iter_content(website_chunk_size):
+        body.extend(chunk)
+        scanner.feed(chunk)
+        if scanner.complete() or len(body) >= website_max_bytes:
+            break  # Early stop: everything is found or the cap is reached
+    scanner.feed(b"", final=True)
+    return bytes(body)
+
+def scan_contact_page(url, scanner):
+    host = urlsplit(url).hostname
+    if not host_health.allow(host):
+        return
+    try:
+        with request_limiter, session.get(url, timeout=host_health.timeout(host), stream=True) as response:
+            host_health.record_success(host, response.elapsed.total_seconds())
+            if response.status_code == 200:
+                read_capped(response, scanner)
+    except network_errors as e:
+        host_health.record_failure(host, e)
+    except requests.exceptions.RequestException as e:
+        logging.warning(f"Failed to fetch contact page {url}: {e}")
+
 def scrape_website(url):
     socials = {"Instagram": "", "Facebook": "", "TikTok": "", "Linkedin": ""}
     email = ""
     if not url or "http" not in url:
         return email, socials
+    key = normalize_url(url)
+    entry = http_cache.get(key) if http_cache else None
+    if entry and entry["fresh"] and entry["result"]:
+        http_cache.count(hit=True)  # Extracted result is stored with the body, so no parsing at all
+        return entry["result"]["email"], entry["result"]["socials"]
+    host = urlsplit(url).hostname
+    if not host_health.allow(host):
+        return email, socials  # Dead or open-circuit host, don't pay its timeout again
+    scanner = ContactScanner(url)
     try:
-        with request_lock:
-            while request_queue.full():
-                time.sleep(0.1)  # Very short wait to minimize delays
-            request_queue.put(1)
-        with session.get(url, timeout=30) as response:  # Increased timeout to 30 seconds
-            soup = BeautifulSoup(response.content, "html.parser")
-            for text in soup.find_all(string=True):
-                if re.search(r'[\w\.-]+@[\w\.-]+', text):
-                    email = re.search(r'[\w\.-]+@[\w\.-]+', text).group()
-                    break
-            for a in soup.find_all("a", href=True):
-                href = a["href"].lower()
-                if "instagram.com" in href and not socials["Instagram"]:
-                    socials["Instagram"] = href
-                elif "facebook.com" in href and not socials["Facebook"]:
-                    socials["Facebook"] = href
-                elif "tiktok.com" in href and not socials["TikTok"]:
-                    socials["TikTok"] = href
-                elif "linkedin.com" in href and not socials["Linkedin"]:
-                    socials["Linkedin"] = href
-    except (requests.exceptions.ConnectTimeout, requests.exceptions.ReadTimeout, requests.exceptions.RequestException) as e:
+        headers = http_cache.conditional_headers(entry) if http_cache else {}
+        with request_limiter, session.get(url, timeout=host_health.timeout(host), headers=headers, stream=True) as response:
+            host_health.record_success(host, response.elapsed.total_seconds())
+            if response.status_code == 304 and entry and entry["result"]:
+                http_cache.refresh(key)
+                http_cache.count(hit=True)
+                return entry["result"]["email"], entry["result"]["socials"]
+            body = read_capped(response, scanner)
+        if not scanner.email:
+            scanner.parse_fallback(body)
+        for link in scanner.contact_links[:contact_page_limit]:
+            if scanner.email:
+                break
+            scan_contact_page(link, scanner)
+        email, socials = scanner.email, scanner.socials
+        if http_cache:
+            http_cache.count(hit=False)
+            if response.status_code == 200:
+                http_cache.put(key, response, body, {"email": email, "socials": socials})
+    except network_errors as e:
+        host_health.record_failure(host, e)
+        logging.warning(f"Timeout or connection error for {url}: {e}")
+        return "", socials  # Skip and return empty data
+    except requests.exceptions.RequestException as e:
         logging.warning(f"Timeout or connection error for {url}: {e}")
         return "", socials  # Skip and return empty data
     except Exception as e:
         logging.error(f"Failed to scrape {url}: {e}")
-    finally:
-        with request_lock:
-            request_queue.get()
     return email, socials
 
-# Step 14: Function to scrape a single business with improved element handling, timeouts, and retries
-def scrape_business(category, city, postal_code, driver_instance, max_attempts=3, max_wait=45, max_execution_time=300):
-    data = []
-    search_query = f"{category} near {postal_code} {city} Spain"
-    attempt = 0
-    start_time = time.time()
-    while attempt < max_attempts and (time.time() - start_time) < max_execution_time:
+# Step 19: Fill in email, socials and the downloaded image of a partial record off the browser thread
+def enrich_website(record, city):
+    try:
+        with metrics.timed("website_fetch", city, record["Category"]):
+            email, socials = scrape_website(record["Web url"])
+        record["Mail"] = email
+        record.update(socials)
+    except Exception as e:
+        logging.error(f"Failed to enrich {record['Business name']} in {city}: {e}")
+    return record
+
+def enrich_image(record, city):
+    image_url = record["Main image of the business"]
+    try:
+        with metrics.timed("image_download", city, record["Category"]):
+            stored = download_image(image_url, record["Business name"], record["Category"], city)
+        if stored:
+            record["_image_url"] = image_url
+            record["_image_sha256"], record["Main image of the business"] = stored
+    except Exception as e:
+        logging.error(f"Failed to download image of {record['Business name']} in {city}: {e}")
+    return record
+
+def submit_enrichment(records, city):
+    futures = []
+    for record in records:
+        futures.append(enrichment_executor.submit(enrich_website, record, city))
+        if record["Main image of the business"]:
+            futures.append(image_executor.submit(enrich_image, record, city))
+    return futures
+
+def wait_for_enrichment(futures):
+    for future in futures:
         try:
-            driver_instance.get("https://www.google.com/maps")
-            time.sleep(3)
+            future.result()
+        except Exception as e:  # Cancelled on shutdown; the record stays partial
+            logging.warning(f"Enrichment did not finish: {e}")
 
-            # Search with longer wait and timeout
-            search_box = WebDriverWait(driver_instance, max_wait).until(
-                EC.presence_of_element_located((By.ID, "searchboxinput")),
-                message=f"Timeout waiting for search box for {category} in {city}"
-            )
-            search_box.clear()
-            search_box.send_keys(search_query)
-            search_box.send_keys(Keys.ENTER)
-            time.sleep(5)
+# Step 20: Event-driven waits, each stage bounded by its own latency budget instead of a fixed sleep
+stage_budgets = {
+    "maps_load": 30,  # Maps page until the search box exists
+    "search": 30,  # Search submitted until the results list exists
+    "scroll": 4,  # One scroll until the results list grows
+    "details": 10,  # Card click until the details pane shows that business
+    "photos": 10,  # Photos tab until a gallery image exists
+}
+wait_poll_interval = 0.1  # Conditions are polled this often, so fast pages move on almost immediately
+details_state_script = """
+const title = document.querySelector("h1.DUwDvf") || document.querySelector("div[role='main'] h1");
+return {title: title ? title.innerText.trim() : "", previous: Boolean(title && title.dataset.previousPane), url: location.href};
+"""
+mark_previous_pane_script = """
+const title = document.querySelector("h1.DUwDvf") || document.querySelector("div[role='main'] h1");
+if (title) title.dataset.previousPane = "1";
+"""
+
+def wait_for(driver_instance, stage, condition, message=""):
+    return WebDriverWait(driver_instance, stage_budgets[stage], poll_frequency=wait_poll_interval).until(condition, message=message)
+
+def results_grew(scrollable, previous_height, previous_cards):
+    # More cards or a taller list (cards may fill a still-short list without changing its height)
+    script = "return [arguments[0].scrollHeight, arguments[0].querySelectorAll('a.hfpxzc').length]"
+    def condition(driver_instance):
+        height, cards = driver_instance.execute_script(script, scrollable)
+        return height > previous_height or cards > previous_cards
+    return condition
+
+def details_show_card(business_name, href):
+    # The pane still shows the previous place until the URL carries this card's feature id (or, for cards without
+    # one, the title element marked before the click is replaced); chains share names, so titles must match exactly
+    feature = place_id_pattern.search(href or "")
+    expected = re.sub(r'\s+', ' ', business_name or "").strip().lower()
+    def condition(driver_instance):
+        state = driver_instance.execute_script(details_state_script) or {}
+        title = re.sub(r'\s+', ' ', state.get("title") or "").strip().lower()
+        if feature:
+            return title == expected and feature.group(1) in unquote(state.get("url") or "")
+        return title == expected and not state.get("previous")
+    return condition
+
+# Step 21: Stream result cards by scrolling the results list until its end or a configurable depth
+results_max_depth = 120  # Most cards taken from one search
+results_stall_limit = 2  # Scrolls in a row that load nothing before the list counts as finished
+results_state_script = """
+const feed = arguments[0], cards = Array.from(feed.querySelectorAll("a.hfpxzc")).slice(arguments[1]);
+return {
+    cards: cards,
+    names: cards.map((card) => card.getAttribute("aria-label") || ""),
+    hrefs: cards.map((card) => card.getAttribute("href") || ""),
+    end: Boolean(feed.querySelector("span.HlvSq")) || /end of the list|final de la lista/i.test(feed.innerText.slice(-300))
+};
+"""
 
-            # Wait for results to be visible and scroll with improved XPath and timeout
+def iter_result_cards(driver_instance, scrollable, max_results=None):
+    # Yields (card, name, href) once per card; the next scroll only happens after the caller has handled the current ones
+    max_results = max_results or results_max_depth
+    offset = 0
+    yielded = 0
+    seen = set()
+    stalled = 0
+    while yielded < max_results:
+        state = driver_instance.execute_script(results_state_script, scrollable, offset)
+        offset += len(state["cards"])
+        for card, name, href in zip(state["cards"], state["names"], state["hrefs"]):
+            if (href or name) in seen:
+                continue
+            seen.add(href or name)
+            yielded += 1
+            yield card, name, href
+            if yielded >= max_results:
+                return
+        if state["end"]:
+            return  # Maps shows its "end of the list" marker
+        height = driver_instance.execute_script(
+            "arguments[0].scrollTop = arguments[0].scrollHeight; return arguments[0].scrollHeight", scrollable)
+        try:
+            with metrics.timed("scroll"):
+                wait_for(driver_instance, "scroll", results_grew(scrollable, height, offset))
+            stalled = 0
+        except TimeoutException:
+            stalled += 1
+            if stalled >= results_stall_limit:
+                return  # Height stopped changing, so there is nothing more to load
+
+# Step 22: Read every detail pane field in one execute_script round trip, falling back to element lookups per missing field
+detail_pane_script = """
+const text = (selector) => { const el = document.querySelector(selector); return el ? el.innerText.trim() : ""; };
+const website = document.querySelector("a[data-item-id='authority']");
+const image = document.querySelector("img[class*='gallery-image'], img[alt*='Photo of']")
+    || document.querySelector("button[jsaction*='heroHeaderImage'] img");
+const hours = [];
+document.querySelectorAll("table[class*='y0skZc'] tr").forEach((row) => {
+    const cells = row.querySelectorAll("td");
+    if (cells.length >= 2) hours.push([cells[0].innerText.split(" ")[0], cells[1].innerText]);
+});
+return {
+    address: text("button[data-item-id='address']"),
+    phone: Array.from(document.querySelectorAll("button[data-item-id*='phone']")).map((el) => el.innerText.trim()).join(" | "),
+    website: website ? website.href : "",
+    hours: hours,
+    image_url: image ? image.src : "",
+    url: window.location.href
+};
+"""
+week_days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+def extract_details(driver_instance, details_pane, business_name):
+    try:
+        found = driver_instance.execute_script(detail_pane_script) or {}
+    except Exception as e:
+        logging.warning(f"Detail script failed for {business_name}, reading fields one by one: {e}")
+        found = {}
+    details = {"address": found.get("address", ""), "phone": found.get("phone", ""), "website": found.get("website", ""),
+               "hours": {day: "" for day in week_days}, "image_url": found.get("image_url", ""), "url": found.get("url", "")}
+    for day, hours in found.get("hours") or []:
+        details["hours"][day] = hours
+
+    # Address (required, so a missing one still fails the business as before)
+    if not details["address"]:
+        details["address"] = details_pane.find_element(By.XPATH, "//button[@data-item-id='address']").text
+
+    # Phone
+    if not details["phone"]:
+        try:
+            phone_elem = details_pane.find_element(By.XPATH, "//button[contains(@data-item-id, 'phone')]")
+            details["phone"] = phone_elem.text
+        except:
+            pass
+
+    # Website
+    if not details["website"]:
+        try:
+            website_elem = details_pane.find_element(By.XPATH, "//a[@data-item-id='authority']")
+            details["website"] = website_elem.get_attribute("href")
+        except:
+            pass
+
+    # Hours
+    if not found.get("hours"):
+        try:
+            hours_table = details_pane.find_element(By.XPATH, "//table[contains(@class, 'y0skZc')]")
+            rows = hours_table.find_elements(By.TAG_NAME, "tr")
+            for row in rows:
+                day = row.find_element(By.XPATH, ".//td[1]").text.split(" ")[0]
+                hours = row.find_element(By.XPATH, ".//td[2]").text
+                details["hours"][day] = hours
+        except:
+            pass
+
+    # Image URL, opening the Photos tab only when the pane had none
+    if not details["image_url"]:
+        try:
             try:
-                # Updated XPaths to handle potential Google Maps changes
-                scrollable_options = [
-                    "//div[contains(@aria-label, 'Results')]",
-                    "//div[contains(@aria-label, 'Resultados')]",  # Spanish version
-                    "//div[contains(@class, 'section-scrollbox')]"  # Fallback class
-                ]
-                scrollable_found = False
-                for xpath in scrollable_options:
-                    try:
-                        scrollable = WebDriverWait(driver_instance, max_wait).until(
-                            EC.presence_of_element_located((By.XPATH, xpath)),
-                            message=f"Timeout waiting for results for {category} in {city} with XPath {xpath}"
-                        )
-                        scrollable_found = True
-                        break
-                    except:
-                        continue
-                if not scrollable_found:
-                    logging.warning(f"Couldn’t find scrollable results in {city} for {category} after trying multiple XPaths")
-                    return []  # Skip this category if no results can be scrolled
+                photos_tab = driver_instance.find_element(By.XPATH, "//button[contains(@aria-label, 'Photos')]")
+                photos_tab.click()
+            except:
+                pass
 
-                for _ in range(3):
-                    driver_instance.execute_script("arguments[0].scrollTop = arguments[0].scrollHeight", scrollable)
-                    time.sleep(2)
-            except Exception as e:
-                logging.warning(f"Couldn’t scroll results in {city} for {category}: {e}")
-                continue  # Retry or skip if scrolling fails
+            image_elem = wait_for(
+                driver_instance, "photos",
+                EC.presence_of_element_located((By.XPATH, "//img[contains(@class, 'gallery-image') or contains(@alt, 'Photo of')]")),
+                message=f"Timeout waiting for image for {business_name}"
+            )
+            details["image_url"] = image_elem.get_attribute("src")
+        except Exception as e:
+            logging.warning(f"Failed to find image for {business_name}: {e}")
+            try:
+                fallback_image = driver_instance.find_element(By.XPATH, "//img[@decoding='async']")
+                details["image_url"] = fallback_image.get_attribute("src")
+            except:
+                pass
 
-            # Extract businesses
-            businesses = driver_instance.find_elements(By.CLASS_NAME, "hfpxzc")
-            if not businesses:
-                logging.warning(f"No businesses found for {category} in {city}")
-                return []
+    # Page URL (holds the coordinates)
+    if not details["url"]:
+        try:
+            details["url"] = driver_instance.current_url
+        except:
+            pass
+    details["image_url"] = details["image_url"] or ""
+    details["website"] = details["website"] or ""
+    return details
 
-            for business in businesses[:5]:  # Limit to 5 for test (adjust as needed)
-                try:
-                    business_name = business.get_attribute("aria-label")
-                    business.click()
-                    time.sleep(3)
+search_outcome_script = """
+if (/consent\\.google\\.|\\/sorry\\//.test(location.href) || document.querySelector("#captcha-form, iframe[src*='recaptcha']"))
+    return {state: "blocked"};
+const feed = document.querySelector("div[aria-label*='Results'], div[aria-label*='Resultados'], div.section-scrollbox");
+if (feed) return {state: "feed", feed: feed};
+const title = document.querySelector("h1.DUwDvf");
+if (title && title.innerText.trim()) return {state: "place", name: title.innerText.trim(), url: location.href};
+const main = document.querySelector("div[role='main']") || document.body;
+if (/can[’']t find|no encuentra|no results|sin resultados/i.test(main.innerText.slice(0, 3000))) return {state: "empty"};
+return null;
+"""
 
-                    details_pane = WebDriverWait(driver_instance, max_wait).until(
-                        EC.presence_of_element_located((By.XPATH, "//div[contains(@class, 'm6QErb')]")),
-                        message=f"Timeout waiting for details pane for {business_name}"
-                    )
+def place_record(key, category, business_name, city, postal_code, details):
+    website = details["website"]
+    hours_dict = details["hours"]
+    image_url = details["image_url"]  # Downloaded later by the enrichment workers
 
-                    # Address
-                    address = details_pane.find_element(By.XPATH, "//button[@data-item-id='address']").text
-                    street = number = postal = city_name = ""
-                    parts = address.split(", ")
-                    if len(parts) > 1:
-                        street_parts = parts[0].split(" ")
-                        number = street_parts[0] if street_parts[0].isdigit() else ""
-                        street = " ".join(street_parts[1:]) if number else parts[0]
-                        postal = parts[-2] if parts[-2].isdigit() else postal_code
-                        city_name = city
-
-                    # Phone
-                    phone = ""
-                    try:
-                        phone_elem = details_pane.find_element(By.XPATH, "//button[contains(@data-item-id, 'phone')]")
-                        phone = phone_elem.text
-                    except:
-                        pass
+    # Add partial record; Mail, socials and the image file are filled in by submit_enrichment, and
+    # address, phones, hours and coordinates stay raw strings until normalize_frame runs at export
+    return {
+        "_place_key": key,
+        "_raw_address": details["address"],
+        "_raw_phones": details["phone"],
+        "_raw_url": details["url"],
+        "Category": category,
+        "Business name": business_name,
+        "Street": "",
+        "Number": "",
+        "Postal code": postal_code,  # Searched postal code, kept when the address has none
+        "City": city,
+        "Phone 1": "",
+        "Phone 2": "",
+        "Mobile 1": "",
+        "Mobile 2": "",
+        "Mail": "",
+        "Web url": website,
+        "Instagram": "",
+        "Facebook": "",
+        "TikTok": "",
+        "Linkedin": "",
+        "Business hours Monday": hours_dict["Monday"],
+        "Business hours Tuesday": hours_dict["Tuesday"],
+        "Business hours Wednesday": hours_dict["Wednesday"],
+        "Business hours Thursday": hours_dict["Thursday"],
+        "Business hours Friday": hours_dict["Friday"],
+        "Business hours Saturday": hours_dict["Saturday"],
+        "Business hours Sunday": hours_dict["Sunday"],
+        "Latitude": "",
+        "Longitude": "",
+        "Main image of the business": image_url or ""
+    }
 
-                    # Website
-                    website = ""
+# Step 23: Function to scrape a single business with improved element handling, timeouts, and retries
+def scrape_business(category, city, postal_code, driver_instance, max_attempts=3, max_execution_time=300, index=None,
+                    max_results=None, outcome=None):
+    # outcome, when given, is filled with "failed" (the search itself never worked) and "duplicates" (cards already scraped)
+    outcome = {} if outcome is None else outcome
+    outcome.update(failed=True, duplicates=0)
+    data = []
+    search_query = f"{category} near {postal_code} {city} Spain"
+    metrics.set_labels(city, category)
+    attempt = 0
+    start_time = time.time()
+    while attempt < max_attempts and (time.time() - start_time) < max_execution_time and not stop_event.is_set():
+        try:
+            # Search as soon as the search box is ready
+            with metrics.timed("maps_load"):
+                driver_instance.get(maps_url)
+                search_box = wait_for(
+                    driver_instance, "maps_load",
+                    EC.presence_of_element_located((By.ID, "searchboxinput")),
+                    message=f"Timeout waiting for search box for {category} in {city}"
+                )
+
+            # Wait for whatever the search turned into: a results list, a single place, "can't find", or a block page
+            try:
+                with metrics.timed("search"):
+                    search_box.clear()
+                    search_box.send_keys(search_query)
+                    search_box.send_keys(Keys.ENTER)
+                    result = wait_for(
+                        driver_instance, "search", lambda driver: driver.execute_script(search_outcome_script),
+                        message=f"Timeout waiting for results for {category} in {city}"
+                    )
+            except TimeoutException:
+                logging.warning(f"Couldn’t find results, a place or a no-results message in {city} for {category}")
+                return data  # Counted as failed; keep what earlier attempts collected
+            if result["state"] == "blocked":
+                logging.warning(f"Search for {category} in {city} hit a consent or captcha page")
+                return data
+            if result["state"] == "empty":
+                logging.warning(f"No businesses found for {category} in {city}")
+                outcome["failed"] = False
+                return data
+            if result["state"] == "place":
+                # Single match: Maps opened the place page directly, so read it as the only result
+                key = place_key(result["url"], result["name"], city)
+                if index is not None and not index.claim(key, category):
+                    metrics.count("duplicates")
+                    outcome["duplicates"] += 1
+                else:
                     try:
-                        website_elem = details_pane.find_element(By.XPATH, "//a[@data-item-id='authority']")
-                        website = website_elem.get_attribute("href")
-                    except:
-                        pass
+                        with metrics.timed("extraction"):
+                            details = extract_details(driver_instance, driver_instance, result["name"])
+                        data.append(place_record(key, category, result["name"], city, postal_code, details))
+                        metrics.count("businesses")
+                    except Exception:
+                        if index is not None:
+                            index.release(key)
+                        raise
+                outcome["failed"] = False
+                return data
+            scrollable = result["feed"]
 
-                    # Scrape website for email and social media
-                    email, socials = scrape_website(website)
+            # Extract businesses as their cards appear, while later ones are still being loaded by scrolling
+            cards_seen = 0
+            for business, business_name, href in iter_result_cards(driver_instance, scrollable, max_results):
+                if stop_event.is_set() or time.time() - start_time >= max_execution_time:
+                    logging.warning(f"Stopping {category} in {city} after {cards_seen} results, time budget used up")
+                    break
+                cards_seen += 1
+                key = None
+                try:
+                    key = place_key(href, business_name, city)
+                    if index is not None and not index.claim(key, category):
+                        logging.info(f"{business_name} already scraped, adding category {category} to it")
+                        metrics.count("duplicates")
+                        outcome["duplicates"] += 1
+                        key = None
+                        continue
+                    with metrics.timed("card_click"):
+                        driver_instance.execute_script(mark_previous_pane_script)
+                        business.click()
+                        # Never read a pane that may still be the previous place's; a timeout skips this card
+                        wait_for(driver_instance, "details", details_show_card(business_name, href),
+                                 message=f"Details pane never showed {business_name}")
 
-                    # Hours
-                    hours_dict = {day: "" for day in ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]}
-                    try:
-                        hours_table = details_pane.find_element(By.XPATH, "//table[contains(@class, 'y0skZc')]")
-                        rows = hours_table.find_elements(By.TAG_NAME, "tr")
-                        for row in rows:
-                            day = row.find_element(By.XPATH, ".//td[1]").text.split(" ")[0]
-                            hours = row.find_element(By.XPATH, ".//td[2]").text
-                            hours_dict[day] = hours
-                    except:
-                        pass
-
-                    # Image with queue management and timeout
-                    image_url = ""
-                    downloaded_image = None
-                    try:
-                        try:
-                            photos_tab = driver_instance.find_element(By.XPATH, "//button[contains(@aria-label, 'Photos')]")
-                            photos_tab.click()
-                            time.sleep(2)
-                        except:
-                            pass
-                        
-                        image_elem = WebDriverWait(driver_instance, max_wait // 2).until(
-                            EC.presence_of_element_located((By.XPATH, "//img[contains(@class, 'gallery-image') or contains(@alt, 'Photo of')]")),
-                            message=f"Timeout waiting for image for {business_name}"
+                        details_pane = wait_for(
+                            driver_instance, "details",
+                            EC.presence_of_element_located((By.XPATH, "//div[contains(@class, 'm6QErb')]")),
+                            message=f"Timeout waiting for details pane for {business_name}"
                         )
-                        image_url = image_elem.get_attribute("src")
-                        if image_url:
-                            downloaded_image = download_image(image_url, business_name, category, city)
-                    except Exception as e:
-                        logging.warning(f"Failed to find image for {business_name}: {e}")
-                        try:
-                            fallback_image = driver_instance.find_element(By.XPATH, "//img[@decoding='async']")
-                            image_url = fallback_image.get_attribute("src")
-                            downloaded_image = download_image(image_url, business_name, category, city)
-                        except:
-                            pass
-
-                    # Coordinates
-                    latitude = longitude = ""
-                    try:
-                        current_url = driver_instance.current_url
-                        if "@" in current_url:
-                            coords = current_url.split("@")[1].split(",")[0:2]
-                            latitude, longitude = coords[0], coords[1]
-                    except:
-                        pass
-
-                    # Add to data
-                    data.append({
-                        "Category": category,
-                        "Business name": business_name,
-                        "Street": street,
-                        "Number": number,
-                        "Postal code": postal,
-                        "City": city_name,
-                        "Phone 1": phone,
-                        "Phone 2": "",
-                        "Mobile 1": "",
-                        "Mobile 2": "",
-                        "Mail": email,
-                        "Web url": website,
-                        "Instagram": socials["Instagram"],
-                        "Facebook": socials["Facebook"],
-                        "TikTok": socials["TikTok"],
-                        "Linkedin": socials["Linkedin"],
-                        "Business hours Monday": hours_dict["Monday"],
-                        "Business hours Tuesday": hours_dict["Tuesday"],
-                        "Business hours Wednesday": hours_dict["Wednesday"],
-                        "Business hours Thursday": hours_dict["Thursday"],
-                        "Business hours Friday": hours_dict["Friday"],
-                        "Business hours Saturday": hours_dict["Saturday"],
-                        "Business hours Sunday": hours_dict["Sunday"],
-                        "Latitude": latitude,
-                        "Longitude": longitude,
-                        "Main image of the business": downloaded_image or image_url or ""
-                    })
+
+                    with metrics.timed("extraction"):
+                        details = extract_details(driver_instance, details_pane, business_name)
+
+                    data.append(place_record(key, category, business_name, city, postal_code, details))
+                    metrics.count("businesses")
 
                 except Exception as e:
                     logging.error(f"Error processing {business_name} in {city} for {category}: {e}")
+                    if index is not None and key:
+                        index.release(key)  # Let a later sighting scrape it properly
                     continue
 
+            if not cards_seen:
+                logging.warning(f"No businesses found for {category} in {city}")
+            outcome["failed"] = False
             return data
 
         except Exception as e:
@@ -405,71 +1394,638 @@ def scrape_business(category, city, postal_code, driver_instance, max_attempts=3
             if attempt < max_attempts:
                 time.sleep(5)
             else:
-                return []
+                return data  # Its places are already claimed in the index, so they must reach the checkpoint
     logging.warning(f"Max execution time ({max_execution_time} seconds) exceeded for {category} in {city}")
-    return []
+    return data
+
+# Step 24: Adaptive scheduling from per-task history: high-yield tasks first, short budgets for tasks that came back empty
+task_stats_path = "task_stats.json"
+default_task_budget = 300  # Seconds a task with no history may take (max_execution_time)
+min_task_budget = 60  # Floor for tasks whose budget was halved after empty runs
+skip_after_empty = 3  # Empty runs in a row before a task is skipped
+reprobe_interval = 14 * 24 * 3600  # Skipped tasks are tried again, last in the queue, once this much time has passed
+
+class TaskStats:
+    def __init__(self):
+        self.path = None
+        self.lock = Lock()
+        self.tasks = {}  # "city|category" -> runs, rows, last_rows, empty_streak, failures, avg_seconds, last_run
+        self.last_save = 0
+
+    def load(self, path=None, shared=()):
+        self.path = path or task_stats_path
+        self.tasks = read_json_files([*shared, self.path])
+        return self
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            snapshot = json.dumps(self.tasks, ensure_ascii=False)
+            self.last_save = time.time()
+        # Each call writes its own temp file, so workers saving at the same time never replace each other's
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(snapshot)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save task stats to {self.path}: {e}")
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def record(self, city, category, rows, seconds, failed, duplicates=0):
+        with self.lock:
+            entry = self.tasks.setdefault(f"{city}|{category}", {
+                "runs": 0, "rows": 0, "last_rows": 0, "empty_streak": 0, "failures": 0, "avg_seconds": seconds, "last_run": 0})
+            entry["runs"] += 1
+            entry["rows"] += rows
+            entry["last_rows"] = rows
+            entry["failures"] += int(failed)
+            if not failed:  # A failed run says nothing about whether the task has results
+                # Cards already scraped under another category still show the search has results
+                entry["empty_streak"] = 0 if rows or duplicates else entry["empty_streak"] + 1
+            entry["avg_seconds"] = 0.7 * entry["avg_seconds"] + 0.3 * seconds
+            entry["last_run"] = time.time()
+            due = time.time() - self.last_save > 30
+            if due:
+                self.last_save = time.time()  # Claimed here, so only this worker saves
+        if due:
+            self.save()
 
-# Step 15: Sequential execution with periodic saving, graceful interruption, and auto-continuation
-def main():
-    global all_data
-    save_interval = 10  # Save every 10 categories
-    categories_processed = 0
-    last_save_time = time.time()
+    def budget(self, city, category):
+        entry = self.tasks.get(f"{city}|{category}")
+        if not entry or not entry["empty_streak"]:
+            return default_task_budget
+        return max(min_task_budget, default_task_budget / 2 ** entry["empty_streak"])
 
+    def score(self, city, category, category_rows, overall_rows):
+        # Expected new records per second of browser time; tasks without history borrow their category's average
+        entry = self.tasks.get(f"{city}|{category}")
+        if not entry:
+            return category_rows.get(category, overall_rows) / (default_task_budget / 2)
+        failure_rate = entry["failures"] / entry["runs"]
+        return entry["rows"] / entry["runs"] * (1 - failure_rate) / max(entry["avg_seconds"], 1)
+
+    def order(self, tasks):
+        per_category = {}
+        for key, entry in self.tasks.items():
+            per_category.setdefault(key.split("|", 1)[1], []).append(entry["rows"] / entry["runs"])
+        category_rows = {category: sum(values) / len(values) for category, values in per_category.items()}
+        overall_rows = sum(category_rows.values()) / len(category_rows) if category_rows else 1.0
+        scheduled, reprobes, skipped = [], [], 0
+        for city, category in tasks:
+            entry = self.tasks.get(f"{city}|{category}")
+            if entry and entry["empty_streak"] >= skip_after_empty:
+                if time.time() - entry["last_run"] >= reprobe_interval:
+                    reprobes.append((city, category))
+                else:
+                    skipped += 1
+                continue
+            scheduled.append((city, category))
+        scheduled.sort(key=lambda task: self.score(*task, category_rows, overall_rows), reverse=True)
+        if skipped or reprobes:
+            logging.info(f"Scheduler: skipping {skipped} repeatedly empty tasks, re-probing {len(reprobes)} of them")
+        return scheduled + reprobes
+
+task_stats = TaskStats()  # In-memory until main() loads the persisted history
+
+# Step 25: Driver pool where each worker owns one Chrome instance and pulls (city, category) tasks from a shared queue
+active_drivers = {}  # worker id -> (driver, port), so shutdown can quit drivers that are mid-task
+drivers_lock = Lock()
+stop_event = Event()
+
+def stop_driver(worker_id):
+    with drivers_lock:
+        entry = active_drivers.pop(worker_id, None)
+    if not entry:
+        return
+    driver_instance, port = entry
     try:
-        for city in cities.keys():
-            for category in categories:
-                try:
-                    data = scrape_business(category, city, cities[city], driver, max_execution_time=300)
-                    all_data.extend(data)
-                    categories_processed += 1
-                    time.sleep(1)  # Small delay between tasks to reduce request pressure
-
-                    # Save periodically (every 10 categories or every 30 minutes)
-                    if categories_processed % save_interval == 0 and all_data:
-                        save_data(f"business_data_partial_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx")
-                        logging.info(f"Partial data saved after {categories_processed} categories")
-
-                    # Save every 30 minutes regardless of category count
-                    if time.time() - last_save_time >= 1800:  # 30 minutes in seconds
-                        save_data(f"business_data_partial_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx")
-                        logging.info(f"Partial data saved after 30 minutes")
-                        last_save_time = time.time()
+        driver_instance.quit()
+    except Exception as e:
+        logging.warning(f"Error quitting driver of worker {worker_id}: {e}")
+    release_port(port)
 
+def is_driver_alive(driver_instance):
+    try:
+        driver_instance.current_url
+        return True
+    except Exception:
+        return False
+
+def driver_worker(worker_id, task_queue, result_queue, index=None):
+    driver_instance = None
+    tasks_on_driver = 0
+    try:
+        while not stop_event.is_set():
+            try:
+                city, category, restarts = task_queue.get_nowait()
+            except Empty:
+                break  # Queue is pre-filled, so empty means all work is handed out
+
+            if driver_instance is None:
+                try:
+                    with metrics.timed("driver_start", city, category):
+                        driver_instance, port = start_driver()
                 except Exception as e:
-                    logging.error(f"Error processing {category} in {city}: {e}")
-                    continue  # Skip to the next category/city if an error occurs, ensuring continuation
+                    logging.critical(f"Worker {worker_id} could not start ChromeDriver: {e}")
+                    task_queue.put((city, category, restarts))  # Leave the task for the remaining workers
+                    return
+                with drivers_lock:
+                    active_drivers[worker_id] = (driver_instance, port)
+                tasks_on_driver = 0
+
+            task_start = time.time()
+            outcome = {}
+            try:
+                data = scrape_business(category, city, cities[city], driver_instance,
+                                       max_execution_time=task_stats.budget(city, category), index=index, outcome=outcome)
+            except Exception as e:
+                logging.error(f"Worker {worker_id} failed on {category} in {city}: {e}")
+                data = []
+                outcome["failed"] = True
+            failed = outcome["failed"]
+            tasks_on_driver += 1
+            metrics.count("tasks_failed" if failed else "tasks_done", city=city, category=category)
+
+            futures = submit_enrichment(data, city)
+            if stop_event.is_set():
+                result_queue.put((city, category, data, futures, False))  # Cut short, so not marked done
+                break
+            driver_alive = is_driver_alive(driver_instance)
+            task_stats.record(city, category, len(data), time.time() - task_start, failed or not driver_alive,
+                              outcome.get("duplicates", 0))
+            if not driver_alive:
+                logging.warning(f"Driver of worker {worker_id} crashed during {category} in {city}, restarting it")
+                stop_driver(worker_id)
+                driver_instance = None
+                if not data and restarts < max_task_restarts:
+                    task_queue.put((city, category, restarts + 1))
+                    continue
+            elif tasks_on_driver >= driver_max_tasks:
+                logging.info(f"Recycling driver of worker {worker_id} after {tasks_on_driver} tasks")
+                stop_driver(worker_id)
+                driver_instance = None
+            result_queue.put((city, category, data, futures, not failed))  # A failed search is tried again on resume
+    finally:
+        stop_driver(worker_id)
+
+def start_pool(tasks, size=None, index=None):
+    task_queue = Queue()
+    for city, category in tasks:
+        task_queue.put((city, category, 0))
+    result_queue = Queue()
+    workers = [Thread(target=driver_worker, args=(i, task_queue, result_queue, index), name=f"driver-{i}", daemon=True)
+               for i in range(size or pool_size)]
+    for worker in workers:
+        worker.start()
+    return workers, result_queue
+
+def shutdown_pool(workers, timeout=30):
+    stop_event.set()
+    for worker_id in list(active_drivers):
+        stop_driver(worker_id)  # Quitting mid-task makes the blocked WebDriver calls fail fast
+    for worker in workers:
+        worker.join(timeout=timeout)
+
+# Step 26: Parallel execution with checkpointing, resume, graceful interruption, and auto-continuation
+def run_scraper(tasks, export=True):
+    global http_cache
+    http_cache = HttpCache()
+    metrics_server = start_metrics_server(metrics_port) if metrics_port else None
+    conn = open_checkpoint()
+    index = PlaceIndex.load(conn)
+    completed = load_completed_tasks(conn)
+    remaining = [task for task in tasks if task not in completed]
+    if len(remaining) < len(tasks):
+        logging.info(f"Resuming from {checkpoint_path}: {len(tasks) - len(remaining)} tasks already done, {len(remaining)} remaining")
+    workers, result_queue = start_pool(task_stats.order(remaining), index=index)
+
+    try:
+        while any(worker.is_alive() for worker in workers) or not result_queue.empty():
+            try:
+                city, category, data, futures, complete = result_queue.get(timeout=1)
+            except Empty:
+                continue
+            try:
+                wait_for_enrichment(futures)  # Only the collector waits; the browsers have already moved on
+                with metrics.timed("save", city, category):
+                    save_batch(conn, city, category, data, complete)
+                attach_pending_categories(conn, index)
+            except Exception as e:
+                logging.error(f"Error processing {category} in {city}: {e}")
+                continue  # Skip to the next result if an error occurs, ensuring continuation
 
-        # Final save
-        if all_data:
-            save_data(f"business_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx")
-            logging.info(f"Final data saved to Excel")
+        # Final export, built from the checkpoint once at the end (sharded runs export after the merge instead)
+        if not export:
+            logging.info(f"Shard finished, its records are in {checkpoint_path}")
+        elif count_records(conn):
+            export_all(conn, f"business_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+            logging.info("Final data exported")
         else:
             logging.warning("No data collected to save.")
 
     except KeyboardInterrupt:
-        # Save on Ctrl + C to prevent data loss
-        if all_data:
-            save_data(f"business_data_interrupted_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx")
-            logging.info(f"Interrupted data saved to Excel")
-        else:
+        # Stop every driver, then checkpoint what was collected on Ctrl + C to prevent data loss
+        logging.info("Interrupted, shutting down all drivers")
+        shutdown_pool(workers)
+        enrichment_executor.shutdown(wait=False, cancel_futures=True)
+        image_executor.shutdown(wait=False, cancel_futures=True)
+        while not result_queue.empty():
+            city, category, data, futures, complete = result_queue.get_nowait()
+            # Keep records even if their enrichment was cancelled, but only mark the task done when it finished
+            enriched = all(future.done() and not future.cancelled() for future in futures)
+            try:
+                save_batch(conn, city, category, data, complete and enriched)
+            except Exception as e:
+                logging.error(f"Could not checkpoint {category} in {city} on interruption: {e}")
+        attach_pending_categories(conn, index)
+        if export and count_records(conn):
+            export_all(conn, f"business_data_interrupted_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+            logging.info(f"Interrupted data exported, rerun to resume from {checkpoint_path}")
+        elif export:
             logging.warning("No data collected to save on interruption.")
-        if driver:
-            driver.quit()
         exit(0)
 
     finally:
-        # Ensure driver is quit and final save occurs even if an error happens
-        if all_data:
-            save_data(f"business_data_final_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx")
-            logging.info(f"Final data saved on script completion or error")
-        if driver:
-            driver.quit()
-
-# Step 16: Helper function to save data to Excel
-def save_data(filename):
-    df = pd.DataFrame(all_data, columns=columns)
-    df.to_excel(filename, index=False, engine='openpyxl')
+        # Ensure every driver and enrichment worker is stopped; collected batches are already in the checkpoint
+        shutdown_pool(workers)
+        enrichment_executor.shutdown(wait=False, cancel_futures=True)
+        image_executor.shutdown(wait=False, cancel_futures=True)
+        conn.close()
+        logging.info(f"HTTP cache stats: {http_cache.stats()}")
+        logging.info(f"Host health stats: {host_health.stats()}")
+        task_stats.save()
+        http_cache.close()
+        metrics.save_summary()
+        logging.info(f"Stage timings written to {metrics_summary_path}: "
+                     + ", ".join(f"{stage} {summary['busy_seconds']}s" for stage, summary in metrics.summary()["stages"].items()))
+        if metrics_server:
+            metrics_server.shutdown()
+
+# Step 27: Sharding: each (city, category) belongs to exactly one shard, and every shard writes its own checkpoint
+output_dir = "."
+
+def output_path(name):
+    return os.path.join(output_dir, name)
+
+def shard_of(city, category, shard_count):
+    return zlib.crc32(f"{city}|{category}".encode("utf-8")) % shard_count  # Stable across processes and machines
+
+def shard_tasks(selected_cities, selected_categories, shard_index=0, shard_count=1):
+    return [(city, category) for city in selected_cities for category in selected_categories
+            if shard_of(city, category, shard_count) == shard_index]
+
+def configure_shard(directory, shard_index=0, shard_count=1):
+    # Per-shard files get a shard suffix; caches and images are shared through the output directory
+    global output_dir, checkpoint_path, http_cache_dir, images_dir, metrics_summary_path
+    output_dir = directory
+    os.makedirs(output_dir, exist_ok=True)
+    suffix = f"_shard_{shard_index}_of_{shard_count}" if shard_count > 1 else ""
+    checkpoint_path = output_path(f"scrape_checkpoint{suffix}.db")
+    http_cache_dir = output_path("http_cache")
+    images_dir = output_path("images")
+    metrics_summary_path = output_path(f"metrics_summary{suffix}.json")
+    host_health.load(output_path(f"dead_hosts{suffix}.json"), shared=glob.glob(output_path("dead_hosts*.json")))
+    task_stats.load(output_path(f"task_stats{suffix}.json"), shared=glob.glob(output_path("task_stats*.json")))
+
+def run_processes(args):
+    # One child process per shard on this machine, then the merge
+    command = [sys.executable, os.path.abspath(__file__), "run", "--shard-count", str(args.processes),
+               "--output-dir", args.output_dir, "--pool-size", str(args.pool_size), "--no-export"]  # The merge exports
+    command += ["--chromedriver", args.chromedriver] if args.chromedriver else []
+    command += ["--cities", *args.cities] if args.cities else []
+    command += ["--categories", *args.categories] if args.categories else []
+    command += ["--lean"] if args.lean else []
+    command += ["--export-format", *args.export_format]
+    children = [subprocess.Popen(command + ["--shard-index", str(i)]
+                                 + (["--metrics-port", str(args.metrics_port + i)] if args.metrics_port else []))
+                for i in range(args.processes)]  # Shard i serves its metrics on --metrics-port + i
+    try:
+        codes = [child.wait() for child in children]
+    except KeyboardInterrupt:
+        logging.info("Interrupted, waiting for the shard processes to checkpoint and exit")
+        codes = [child.wait() for child in children]  # They got the same Ctrl + C and save on their own
+        return
+    if any(codes):
+        logging.error(f"Shard exit codes {codes}, merging what was checkpointed")
+    merge_shards(args.output_dir)
+
+# Step 28: Merge shard checkpoints into one deduplicated dataset with a stable row order
+def merge_shards(directory, merged_name="scrape_merged.db", export=True):
+    global output_dir
+    output_dir = directory
+    merged_path = output_path(merged_name)
+    sources = sorted(glob.glob(output_path("scrape_checkpoint*.db")))
+    if os.path.exists(merged_path):
+        os.remove(merged_path)  # Rebuilt from the shards every time, so the result never depends on merge history
+    conn = open_checkpoint(merged_path)
+    city_rank = {city: i for i, city in enumerate(cities)}
+    category_rank = {category: i for i, category in enumerate(categories)}
+    conn.execute("""CREATE TEMP TABLE staging (
+        place_key TEXT, city_rank INTEGER, category_rank INTEGER, name TEXT, data TEXT)""")
+    for source in sources:
+        source_conn = sqlite3.connect(source)
+        rows = []
+        for city, category, key, data in source_conn.execute("SELECT city, category, place_key, data FROM records ORDER BY id"):
+            record = json.loads(data)
+            key = key or place_key(None, record["Business name"], city)
+            rows.append((key, city_rank.get(city, len(city_rank)), category_rank.get(category, len(category_rank)),
+                         record["Business name"] or "", data))
+        conn.executemany("INSERT INTO staging VALUES (?, ?, ?, ?, ?)", rows)
+        conn.executemany("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?)", source_conn.execute("SELECT * FROM tasks"))
+        conn.executemany("INSERT OR IGNORE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)", source_conn.execute("SELECT * FROM images"))
+        source_conn.close()
+        logging.info(f"Merged {len(rows)} records from {source}")
+
+    # The first sighting (by city, then category order) wins; later sightings only add their categories
+    conn.execute("CREATE TEMP TABLE merged (place_key TEXT, city_rank INTEGER, category_rank INTEGER, name TEXT, data TEXT)")
+    current_key, current = None, None
+    def flush():
+        if current:
+            conn.execute("INSERT INTO merged VALUES (?, ?, ?, ?, ?)", current)
+    for key, c_rank, k_rank, name, data in conn.cursor().execute(
+            "SELECT * FROM staging ORDER BY place_key, city_rank, category_rank, name, data"):  # Streamed, not loaded
+        if key != current_key:
+            flush()
+            current_key, current = key, (key, c_rank, k_rank, name, data)
+            continue
+        record = json.loads(current[4])
+        merged_categories = record["Category"].split("; ")
+        for category in json.loads(data)["Category"].split("; "):
+            if category not in merged_categories:
+                merged_categories.append(category)
+        record["Category"] = "; ".join(sorted(merged_categories, key=lambda category: category_rank.get(category, len(category_rank))))
+        current = current[:4] + (json.dumps(record, ensure_ascii=False),)
+    flush()
+    with conn:
+        conn.execute("""INSERT INTO records (city, category, place_key, data)
+                        SELECT json_extract(data, '$.City'), json_extract(data, '$.Category'), place_key, data
+                        FROM merged ORDER BY city_rank, category_rank, name, place_key""")
+    total = count_records(conn)
+    logging.info(f"Merged dataset has {total} unique places in {merged_path}")
+    if export and total:
+        export_all(conn, f"business_data_merged_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    conn.close()
+    return merged_path
+
+# Step 29: Command line entry point
+def parse_args(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or argv[0].startswith("-"):
+        argv.insert(0, "run")  # Plain `python a.py` keeps scraping everything, as before
+    parser = argparse.ArgumentParser(description="Scrape Google Maps businesses per city and category")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Scrape (this shard of) the city x category tasks")
+    run_parser.add_argument("--shard-index", type=int, default=0)
+    run_parser.add_argument("--shard-count", type=int, default=1, help="Total shards, across processes or machines")
+    run_parser.add_argument("--processes", type=int, default=0, help="Start this many local shard processes, then merge")
+    run_parser.add_argument("--cities", nargs="+", help="Only these cities (default: all)")
+    run_parser.add_argument("--categories", nargs="+", help="Only these categories (default: all)")
+    run_parser.add_argument("--output-dir", default=".", help="Checkpoints, caches, images and exports go here")
+    run_parser.add_argument("--pool-size", type=int, default=pool_size, help="Chrome instances per process")
+    run_parser.add_argument("--lean", action="store_true", help="Block tiles, fonts, images and analytics in Chrome")
+    run_parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this local port")
+    run_parser.add_argument("--no-export", action="store_true", help="Only checkpoint; export later with merge")
+    merge_parser = commands.add_parser("merge", help="Merge shard checkpoints into one deduplicated dataset")
+    merge_parser.add_argument("--output-dir", default=".")
+    for command_parser in (run_parser, merge_parser):
+        command_parser.add_argument("--export-format", nargs="+", choices=[e[1:] for e in exporters],
+                                    default=export_formats, help="Formats written from the checkpoint at the end")
+    compare_parser = commands.add_parser("compare-browser-modes", help="Measure the normal and lean browser modes on one search")
+    for command_parser in (run_parser, compare_parser):
+        command_parser.add_argument("--chromedriver", help=f"ChromeDriver executable on this machine (default: {chromedriver_path})")
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        unknown = set(args.cities or []) - set(cities) or set(args.categories or []) - set(categories)
+        if unknown:
+            parser.error(f"unknown cities/categories: {', '.join(sorted(unknown))}")
+        if not 0 <= args.shard_index < args.shard_count:
+            parser.error("--shard-index must be between 0 and --shard-count - 1")
+    return args
+
+def main(argv=None):
+    global pool_size, lean_mode, export_formats, metrics_port, chromedriver_path
+    args = parse_args(argv)
+    if getattr(args, "chromedriver", None):
+        chromedriver_path = args.chromedriver
+    if args.command != "compare-browser-modes":
+        export_formats = args.export_format
+    if args.command == "compare-browser-modes":
+        compare_browser_modes()
+    elif args.command == "merge":
+        merge_shards(args.output_dir)
+    elif args.processes:
+        run_processes(args)
+    else:
+        pool_size = args.pool_size
+        lean_mode = args.lean
+        metrics_port = args.metrics_port
+        configure_shard(args.output_dir, args.shard_index, args.shard_count)
+        tasks = shard_tasks([city for city in cities if not args.cities or city in args.cities],
+                            [category for category in categories if not args.categories or category in args.categories],
+                            args.shard_index, args.shard_count)
+        logging.info(f"Shard {args.shard_index + 1}/{args.shard_count}: {len(tasks)} tasks")
+        run_scraper(tasks, export=args.shard_count == 1 and not args.no_export)
+
+# Step 30: Vectorized normalization of the raw address, phone, hours and coordinate strings, run per export chunk
+raw_columns = ["_raw_address", "_raw_phones", "_raw_url"]
+phone_columns = ["Phone 1", "Phone 2", "Mobile 1", "Mobile 2"]
+hours_columns = [f"Business hours {day}" for day in week_days]
+postal_code_pattern = re.compile(r'\b(\d{5})\b')
+# "Calle Mayor 12, ...", "C. de Alcalá, 45, ..." or "12 Calle Mayor, ..."; five digit numbers are postal codes, not house numbers
+street_number_pattern = re.compile(
+    r'^\s*(?:(?P<lead>\d{1,4}[A-Za-z]?)\s+)?(?P<street>[^,]*?)(?:,?\s+(?P<number>\d{1,4}[A-Za-z]?|[Ss]/[Nn])\b)?\s*(?:,|$)')
+phone_pattern = re.compile(r'(?<![\d+])(?:(?:\+|00)\s?34[\s.-]?)?([6789](?:[\s.-]?\d){8})(?!\d)')
+phone_separator_pattern = re.compile(r'[\s.-]')
+viewport_coords_pattern = re.compile(r'@(-?\d+\.\d+),(-?\d+\.\d+)')
+hours_space_pattern = re.compile(r'[\u00a0\u202f\u2009]')
+closed_pattern = re.compile(r'^\s*(?:closed|cerrado)\s*$', re.IGNORECASE)
+all_day_pattern = re.compile(r'(?:open 24 hours|abierto 24 horas)', re.IGNORECASE)
+hours_range_pattern = re.compile(
+    r'(\d{1,2})(?:[:.](\d{2}))?(?:\s*([AaPp])\.?\s?[Mm]\.?)?\s*[-\u2013\u2014]\s*(\d{1,2})(?:[:.](\d{2}))?(?:\s*([AaPp])\.?\s?[Mm]\.?)?')
+hours_separator_pattern = re.compile(r'\s*(?:\n|,|;)\s*')
+
+def clock(hour, minute, suffix):
+    hour = int(hour)
+    if suffix:
+        hour = hour % 12 + (12 if suffix.lower() == "p" else 0)
+    return f"{hour:02d}:{minute or '00'}"
+
+def compact_hours_range(match):
+    start_hour, start_minute, start_suffix, end_hour, end_minute, end_suffix = match.groups()
+    # "5–8:30 p.m." states the suffix once; the start shares it unless that would put it after the end
+    if not start_suffix and end_suffix:
+        start_suffix = end_suffix if int(start_hour) % 12 <= int(end_hour) % 12 else ("a" if end_suffix.lower() == "p" else "p")
+    return f"{clock(start_hour, start_minute, start_suffix)}-{clock(end_hour, end_minute, end_suffix)}"
+
+def normalize_hours(hours):
+    hours = hours.fillna("").astype(str).str.replace(hours_space_pattern, " ", regex=True)
+    hours = hours.str.replace(closed_pattern, "Closed", regex=True)
+    hours = hours.str.replace(all_day_pattern, "00:00-24:00", regex=True)
+    hours = hours.str.replace(hours_range_pattern, compact_hours_range, regex=True)
+    return hours.str.replace(hours_separator_pattern, ", ", regex=True).str.strip(", ")
+
+def classify_phones(df, raw_phones):
+    # Every Spanish number in the raw text, one row per match: 6xx/7xx fill the mobile columns, the rest the landlines
+    matches = raw_phones.str.extractall(phone_pattern)[0]
+    if matches.empty:
+        return
+    matches.index.names = ["row", "match"]
+    found = ("+34" + matches.str.replace(phone_separator_pattern, "", regex=True)).to_frame("number").reset_index()
+    found = found.drop_duplicates(["row", "number"])
+    found["kind"] = found["number"].str[3].isin(["6", "7"]).map({True: "Mobile", False: "Phone"})
+    found["slot"] = found.groupby(["row", "kind"]).cumcount() + 1
+    found = found[found["slot"] <= 2]
+    wide = found.assign(column=found["kind"] + " " + found["slot"].astype(str)).pivot(index="row", columns="column", values="number")
+    rows = raw_phones.index[raw_phones != ""]
+    for column in phone_columns:
+        df.loc[rows, column] = wide[column].reindex(rows).fillna("") if column in wide else ""
+
+def normalize_frame(df):
+    # Rows from checkpoints written before the raw fields existed keep their already parsed values
+    for column in raw_columns:
+        df[column] = df[column].fillna("").astype(str) if column in df else ""
+    address = df["_raw_address"]
+    has_address = address != ""
+    if has_address.any():
+        parts = address[has_address].str.extract(street_number_pattern)
+        df.loc[has_address, "Street"] = parts["street"].str.strip().fillna("")
+        df.loc[has_address, "Number"] = parts["number"].fillna(parts["lead"]).fillna("")
+        postal = address[has_address].str.extract(postal_code_pattern)[0]
+        df.loc[has_address, "Postal code"] = postal.fillna(df.loc[has_address, "Postal code"])
+
+    classify_phones(df, df["_raw_phones"].where(df["_raw_phones"] != "", df["Phone 1"].fillna("").astype(str)))
+
+    for column in hours_columns:
+        df[column] = normalize_hours(df[column])
+
+    coords = df["_raw_url"].str.extract(place_coords_pattern)
+    coords = coords.fillna(df["_raw_url"].str.extract(viewport_coords_pattern))  # Map viewport when the place pin is missing
+    for i, column in enumerate(float_columns):
+        df[column] = pd.to_numeric(coords[i], errors="coerce").fillna(pd.to_numeric(df[column], errors="coerce"))
+    return df[columns]
+
+# Step 31: Exporters that stream the checkpointed records straight into the output file, picked by extension
+export_formats = ["xlsx"]  # Written at the end of a run or a merge: any of xlsx, csv, parquet
+export_chunk_size = 5000  # Records per DataFrame chunk for the CSV and Parquet exporters
+float_columns = ["Latitude", "Longitude"]
+categorical_columns = ["Category", "City"]
+
+def iter_record_frames(conn, chunk_size=None):
+    chunk = []
+    for record in iter_records(conn):
+        chunk.append(record)
+        if len(chunk) >= (chunk_size or export_chunk_size):
+            yield record_frame(chunk)
+            chunk = []
+    if chunk:
+        yield record_frame(chunk)
+
+def record_frame(records):
+    return normalize_frame(pd.DataFrame.from_records(records, columns=columns + raw_columns))
+
+def export_csv(filename, conn):
+    with open(filename, "w", encoding="utf-8", newline="") as f:
+        for i, df in enumerate(iter_record_frames(conn)):
+            df.to_csv(f, index=False, header=i == 0)
+
+def export_parquet(filename, conn):
+    if pq is None:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+    schema = pa.schema([(column, pa.float64() if column in float_columns
+                         else pa.dictionary(pa.int32(), pa.string()) if column in categorical_columns
+                         else pa.string()) for column in columns])
+    with pq.ParquetWriter(filename, schema) as writer:
+        for df in iter_record_frames(conn):
+            for column in categorical_columns:
+                df[column] = df[column].astype("category")
+            writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+
+def iter_record_rows(conn):
+    for df in iter_record_frames(conn):
+        yield from df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)  # NaN becomes a blank cell
+
+def export_excel(filename, conn):
+    # Rows go to disk as they are written: xlsxwriter constant_memory or openpyxl write_only, never a full sheet in memory
+    if xlsxwriter is not None:
+        workbook = xlsxwriter.Workbook(filename, {"constant_memory": True, "strings_to_urls": False})
+        sheet = workbook.add_worksheet()
+        sheet.write_row(0, 0, columns)
+        for i, row in enumerate(iter_record_rows(conn), start=1):
+            sheet.write_row(i, 0, row)
+        workbook.close()
+    else:
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(columns)
+        for row in iter_record_rows(conn):
+            sheet.append(row)
+        workbook.save(filename)
+
+exporters = {".xlsx": export_excel, ".csv": export_csv, ".parquet": export_parquet}
+
+rss_sample_interval = 0.05  # Seconds between RSS samples taken while an export runs
+
+def peak_rss_mb():
+    # Peak of the whole process lifetime, so after a scrape this is the scraping peak, not the export's
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024, 1)  # Bytes on macOS, KiB on Linux
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / 1024 ** 2, 1)  # Peak working set on Windows
+    return None
+
+def current_rss_mb():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 1024 ** 2
+    try:
+        with open("/proc/self/statm") as f:  # Linux without psutil: resident pages
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+@contextmanager
+def sampled_peak_rss():
+    # Highest RSS seen while the block runs, sampled on a background thread; None where RSS can't be read
+    result = {"peak_mb": current_rss_mb()}
+    done = Event()
+    def sample():
+        while not done.wait(rss_sample_interval):
+            rss = current_rss_mb()
+            if rss is not None:
+                result["peak_mb"] = max(result["peak_mb"] or 0, rss)
+    sampler = Thread(target=sample, name="rss-sampler", daemon=True)
+    sampler.start()
+    try:
+        yield result
+    finally:
+        done.set()
+        sampler.join()
+        if result["peak_mb"] is not None:
+            result["peak_mb"] = round(max(result["peak_mb"], current_rss_mb()), 1)
+
+def save_data(filename, conn):
+    exporter = exporters[os.path.splitext(filename)[1].lower()]
+    start = time.time()
+    with sampled_peak_rss() as rss:
+        exporter(filename, conn)
+    stats = {"file": filename, "seconds": round(time.time() - start, 2), "export_peak_rss_mb": rss["peak_mb"],
+             "process_peak_rss_mb": peak_rss_mb(), "size_mb": round(os.path.getsize(filename) / 1024 ** 2, 2)}
+    logging.info(f"Exported {filename} in {stats['seconds']}s, peak RSS during export {stats['export_peak_rss_mb']} MB "
+                 f"(process peak {stats['process_peak_rss_mb']} MB)")
+    return stats
+
+def export_all(conn, stem):
+    for extension in export_formats:
+        try:
+            save_data(output_path(f"{stem}.{extension}"), conn)
+        except Exception as e:
+            logging.error(f"Export to {extension} failed: {e}")  # One failed format must not cost the others
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,411 @@
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import socket
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from html import escape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, unquote, parse_qs
+
+import a
+
+# Step 1: Fixture layout; every fixture is derived from a seed so runs are comparable
+fast_host = "127.0.0.1"  # Fake Maps, normal websites and images
+slow_host = "127.0.0.3"  # Websites that answer after a delay (own host, so the circuit breaker treats it separately)
+dead_host = "127.0.0.2"  # Nothing listens here, so connections are refused
+week_days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+site_kinds = ["mailto", "text", "contact_page", "entities", "large", "no_email", "slow", "dead"]
+
+def seeded(*parts):
+    return random.Random(zlib.crc32("|".join(str(part) for part in parts).encode("utf-8")))
+
+def closed_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((fast_host, 0))
+        return s.getsockname()[1]  # Released on close, so nothing is listening on it afterwards
+
+def make_places(query, base_url, dead_url, max_places=40):
+    rng = seeded("places", query)
+    # Some queries return nothing and some a single match, which Maps shows without a results list
+    count = 0 if "library" in query.lower() else 1 if "museum" in query.lower() else rng.randint(5, max_places)
+    places = []
+    for i in range(count):
+        place_id = f"0x{rng.getrandbits(60):x}:0x{rng.getrandbits(60):x}"
+        name = f"{query.split(' near ')[0].title()} {rng.choice(['Sol', 'Luna', 'Mar', 'Rio', 'Sierra'])} {i + 1}"
+        site = rng.randrange(10_000)
+        kind = site_kinds[site % len(site_kinds)]
+        if kind == "dead":
+            website = f"{dead_url}/site/{site}"
+        elif kind == "slow":
+            website = f"{base_url.replace(fast_host, slow_host)}/site/{site}"
+        else:
+            website = f"{base_url}/site/{site}"
+        places.append({
+            "id": place_id, "name": name, "lat": round(40 + rng.random(), 6), "lng": round(-3.7 + rng.random(), 6),
+            "address": f"Calle {rng.choice(['Mayor', 'Alcalá', 'Gran Vía'])} {rng.randint(1, 200)}, "
+                       f"{rng.randint(28001, 28080):05d} Madrid, Spain",
+            "phone": f"+34 {rng.choice('6789')}{rng.randint(10, 99)} {rng.randint(100, 999)} {rng.randint(100, 999)}",
+            "website": website if rng.random() < 0.85 else "",
+            "hours": [[day, "9:00–20:00" if day != "Sunday" else "Closed"] for day in week_days],
+            "image": f"{base_url}/img/{site}.jpg?kb={rng.choice([8, 40, 150, 600])}",
+        })
+    return places
+
+def make_site(site_id, path, base_url):
+    rng = seeded("site", site_id)
+    kind = site_kinds[site_id % len(site_kinds)]
+    email = f"info{site_id}@example-{site_id}.es"
+    socials = "".join(f'<a href="https://www.{network}.com/shop{site_id}">{network}</a>'
+                      for network in ["instagram", "facebook", "tiktok", "linkedin"] if rng.random() < 0.7)
+    if path.endswith("/contacto"):
+        return f"<html><body><h1>Contacto</h1><p>Escríbenos a {email}</p></body></html>"
+    body = {
+        "mailto": f'<a href="mailto:{email}">Email</a>',
+        "text": f"<p>Email: {email}</p>",
+        "contact_page": f'<a href="{base_url}/site/{site_id}/contacto">Contacto</a>',
+        "entities": f"<p>info{site_id}&#64;example-{site_id}.es</p>",
+    }.get(kind, "")
+    padding_kb = 2000 if kind == "large" else rng.choice([20, 60, 150])
+    padding = "<p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * (padding_kb * 1024 // 57) + "</p>"
+    return f"<html><head><title>Shop {site_id}</title></head><body>{padding}{body}{socials}</body></html>"
+
+# Step 2: Fake Maps pages using the same markup scrape_business targets
+maps_home_page = """<html><body>
+<input id="searchboxinput">
+<script>
+document.getElementById("searchboxinput").addEventListener("keydown", (event) => {
+    if (event.key === "Enter") location.href = "/maps/search/" + encodeURIComponent(event.target.value);
+});
+</script></body></html>"""
+
+maps_details_js = """function showDetails(place) {
+    const hours = place.hours.map(([day, time]) => `<tr><td>${day}</td><td>${time}</td></tr>`).join("");
+    const website = place.website ? `<a data-item-id="authority" href="${place.website}">${place.website}</a>` : "";
+    document.getElementById("details").innerHTML = `<div class="m6QErb">
+        <h1 class="DUwDvf">${place.name}</h1>
+        <button data-item-id="address">${place.address}</button>
+        <button data-item-id="phone:tel:${place.phone.replace(/ /g, "")}">${place.phone}</button>
+        ${website}
+        <table class="y0skZc">${hours}</table>
+        <button aria-label="Photos of ${place.name}">Photos</button>
+        <img alt="Photo of ${place.name}" src="${place.image}">
+    </div>`;
+    history.pushState({}, "", `/maps/place/${encodeURIComponent(place.name)}/@${place.lat},${place.lng},17z/data=!4m7!3m6!1s${place.id}!8m2!3d${place.lat}!4d${place.lng}`);
+}
+"""
+
+maps_search_page = """<html><body style="display:flex">
+<div aria-label="Results for __QUERY__" role="feed" style="width:400px;height:900px;overflow-y:scroll"></div>
+<div id="details"></div>
+<script>
+const places = __PLACES__, pageSize = 7, delay = __DELAY__;
+const feed = document.querySelector("div[role='feed']");
+let shown = 0, loading = false;
+function showMore() {
+    for (const place of places.slice(shown, shown + pageSize)) {
+        const card = document.createElement("a");
+        card.className = "hfpxzc";
+        card.setAttribute("aria-label", place.name);
+        card.href = `/maps/place/${encodeURIComponent(place.name)}/data=!4m7!3m6!1s${place.id}!8m2!3d${place.lat}!4d${place.lng}`;
+        card.style = "display:block;height:120px";
+        card.textContent = place.name;
+        card.addEventListener("click", (event) => { event.preventDefault(); setTimeout(() => showDetails(place), delay); });
+        feed.appendChild(card);
+    }
+    shown = Math.min(shown + pageSize, places.length);
+    if (shown >= places.length) feed.insertAdjacentHTML("beforeend", "<span class='HlvSq'>You've reached the end of the list.</span>");
+    loading = false;
+}
+feed.addEventListener("scroll", () => {
+    if (!loading && shown < places.length && feed.scrollTop + feed.clientHeight >= feed.scrollHeight - 5) {
+        loading = true;
+        setTimeout(showMore, delay);
+    }
+});
+__DETAILS_JS__setTimeout(showMore, delay);
+</script></body></html>"""
+
+maps_search_page = maps_search_page.replace("__DETAILS_JS__", maps_details_js)
+
+maps_place_page = """<html><body><div role="main"><div id="details"></div></div>
+<script>
+""" + maps_details_js + """showDetails(__PLACE__);
+</script></body></html>"""
+
+maps_no_results_page = """<html><body><div role="main">
+<div>Google Maps can't find __QUERY__</div>
+<div>Make sure your search is spelled correctly.</div>
+</div></body></html>"""
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeMaps/1.0"
+    base_url = ""
+    dead_url = ""
+    page_delay = 0.05  # Seconds the fake Maps waits before rendering cards or a details pane
+    slow_latency = 1.5  # Seconds the slow host waits before answering
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type, status=200, headers=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        path = unquote(parts.path)
+        if self.server.server_address[0] == slow_host:
+            time.sleep(self.slow_latency)
+        if path in ("/maps", "/maps/"):
+            self.send_body(maps_home_page, "text/html; charset=utf-8")
+        elif path.startswith("/maps/search/"):
+            query = path[len("/maps/search/"):]
+            places = make_places(query, self.base_url, self.dead_url)
+            if not places:
+                page = maps_no_results_page.replace("__QUERY__", escape(query))
+            elif len(places) == 1:
+                page = maps_place_page.replace("__PLACE__", json.dumps(places[0]))
+            else:
+                page = (maps_search_page.replace("__QUERY__", escape(query)).replace("__PLACES__", json.dumps(places))
+                        .replace("__DELAY__", str(int(self.page_delay * 1000))))
+            self.send_body(page, "text/html; charset=utf-8")
+        elif path.startswith("/site/"):
+            site_id = int(path.split("/")[2])
+            page = make_site(site_id, path, self.base_url)
+            etag = f'"site-{site_id}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_body(b"", "text/html", status=304, headers={"ETag": etag})
+            else:
+                self.send_body(page, "text/html; charset=utf-8", headers={"ETag": etag})
+        elif path.startswith("/img/"):
+            kilobytes = int(parse_qs(parts.query).get("kb", ["40"])[0])
+            image = b"\xff\xd8\xff\xe0" + seeded("img", path).randbytes(kilobytes * 1024) + b"\xff\xd9"
+            self.send_body(image, "image/jpeg", headers={"ETag": f'"{zlib.crc32(image)}"'})
+        else:
+            self.send_body("not found", "text/plain", status=404)
+
+class FixtureServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # Clients that stop reading early (capped or early-stopped downloads) reset the connection on purpose
+
+def start_fixture_servers():
+    servers = []
+    for host in (fast_host, slow_host):
+        server = FixtureServer((host, 0 if host == fast_host else servers[0].server_address[1]), FixtureHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    port = servers[0].server_address[1]
+    FixtureHandler.base_url = f"http://{fast_host}:{port}"
+    FixtureHandler.dead_url = f"http://{dead_host}:{closed_port()}"
+    return servers
+
+# Step 3: Measurement helpers
+class StageTimer:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.samples[name].append(time.perf_counter() - start)
+        return timed
+
+    def summary(self):
+        return {name: {"count": len(values), "total_s": sum(values), "mean_ms": statistics.mean(values) * 1000,
+                       "p95_ms": sorted(values)[math.ceil(len(values) * 0.95) - 1] * 1000}
+                for name, values in sorted(self.samples.items())}
+
+def run_measured(name, func, trace_memory=False):
+    if trace_memory:
+        tracemalloc.start()  # Accurate Python peak, but slows CPU-bound stages noticeably
+    start = time.perf_counter()
+    try:
+        with a.sampled_peak_rss() as rss:  # Sampled during this benchmark only, so earlier stages don't mask it
+            details = func() or {}
+    finally:
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2 if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+    result = {"benchmark": name, "seconds": elapsed, "python_peak_mb": peak, "rss_peak_mb": rss["peak_mb"]}
+    result.update(details)
+    return result
+
+# Step 4: Benchmarks for each stage
+def fixture_urls(kind, count, seed=7):
+    rng = seeded("urls", kind, seed)
+    places = []
+    while len(places) < count:
+        places.extend(make_places(f"Shop {rng.randrange(10 ** 6)} near 28001 Madrid Spain",
+                                  FixtureHandler.base_url, FixtureHandler.dead_url))
+    return [place[kind] for place in places[:count] if place[kind]]
+
+def bench_scrape_website(count, workers):
+    urls = fixture_urls("website", count)
+    timer = StageTimer()
+    scrape = timer.wrap("scrape_website", a.scrape_website)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        found = sum(1 for email, socials in executor.map(scrape, urls) if email)
+    stats = timer.summary()["scrape_website"]
+    return {"calls": len(urls), "emails_found": found, "mean_ms": stats["mean_ms"], "p95_ms": stats["p95_ms"],
+            "http_cache": a.http_cache.stats() if a.http_cache else None, "host_health": a.host_health.stats()}
+
+def bench_download_image(count, workers):
+    urls = fixture_urls("image", count)
+    timer = StageTimer()
+    download = timer.wrap("download_image", a.download_image)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        saved = sum(1 for path in executor.map(lambda item: download(item[1], f"Shop {item[0]}", "Bench", "Bench"),
+                                               enumerate(urls)) if path)
+    stats = timer.summary()["download_image"]
+    return {"calls": len(urls), "saved": saved, "mean_ms": stats["mean_ms"], "p95_ms": stats["p95_ms"]}
+
+def fill_bench_checkpoint(records):
+    conn = a.open_checkpoint(os.path.join(os.getcwd(), "bench_checkpoint.db"))
+    rng = seeded("records")
+    batch = []
+    for i in range(records):
+        record = {column: f"{column} {rng.randrange(10 ** 6)}" for column in a.columns}
+        record.update({"Latitude": f"40.{rng.randrange(10 ** 6)}", "Longitude": f"-3.{rng.randrange(10 ** 6)}"})
+        record["_place_key"] = f"0x{i:x}:0x{i:x}"
+        batch.append(record)
+        if len(batch) == 500:
+            a.save_batch(conn, "Bench", f"Category {i // 500}", batch)
+            batch = []
+    if batch:
+        a.save_batch(conn, "Bench", "Category last", batch)
+    conn.close()
+
+def bench_save_data(records, extension):
+    conn = a.open_checkpoint(os.path.join(os.getcwd(), "bench_checkpoint.db"))
+    try:
+        stats = a.save_data(f"bench_output.{extension}", conn)
+    finally:
+        conn.close()
+    return {"rows": records, "export_seconds": stats["seconds"], "file_mb": stats["size_mb"]}
+
+def bench_scrape_business(queries):
+    timer = StageTimer()
+    original_wait_for, original_extract = a.wait_for, a.extract_details
+    a.wait_for = lambda driver_instance, stage, condition, message="": timer.wrap(f"wait {stage}", original_wait_for)(
+        driver_instance, stage, condition, message)
+    a.extract_details = timer.wrap("extract_details", original_extract)
+    a.maps_url = f"{FixtureHandler.base_url}/maps"
+    driver_instance, port = a.start_driver()
+    businesses = 0
+    try:
+        scrape = timer.wrap("scrape_business", a.scrape_business)
+        for city, category in queries:
+            businesses += len(scrape(category, city, a.cities[city], driver_instance, max_execution_time=120))
+    finally:
+        driver_instance.quit()
+        a.release_port(port)
+        a.wait_for, a.extract_details = original_wait_for, original_extract
+    total = sum(timer.samples["scrape_business"])
+    return {"queries": len(queries), "businesses": businesses,
+            "businesses_per_min": businesses / total * 60 if total else 0.0, "stages": timer.summary()}
+
+# Step 5: Run everything against the local fixtures and report the numbers
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the scraper using a local fake Maps server")
+    parser.add_argument("--sites", type=int, default=80, help="Fixture websites passed to scrape_website")
+    parser.add_argument("--images", type=int, default=80, help="Fixture images passed to download_image")
+    parser.add_argument("--records", type=int, default=5000, help="Rows exported by save_data")
+    parser.add_argument("--export-format", nargs="+", default=["xlsx", "csv", "parquet"], help="Exporters to measure")
+    parser.add_argument("--queries", type=int, default=4, help="Fake Maps searches run through scrape_business")
+    parser.add_argument("--skip-browser", action="store_true", help="Skip scrape_business (needs Chrome/ChromeDriver)")
+    parser.add_argument("--chromedriver", help="ChromeDriver executable (default: a.chromedriver_path, else Selenium Manager)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Record each benchmark's Python peak memory with tracemalloc (inflates timings)")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+    if args.chromedriver:
+        a.chromedriver_path = args.chromedriver
+
+    logging.getLogger().setLevel(logging.ERROR)  # The scraper's per-request logging would drown the report
+    servers = start_fixture_servers()
+    workdir = tempfile.mkdtemp(prefix="scraper_bench_")
+    cwd = os.getcwd()
+    os.chdir(workdir)  # Images, caches and exports land in the scratch directory
+    results = []
+
+    def measure(name, func):
+        results.append(run_measured(name, func, args.trace_memory))
+
+    try:
+        a.http_cache = None
+        a.host_health = a.HostHealth()
+        measure("scrape_website (cold)", lambda: bench_scrape_website(args.sites, a.enrichment_workers))
+        a.http_cache = a.HttpCache(os.path.join(workdir, "http_cache"))
+        a.host_health = a.HostHealth()
+        bench_scrape_website(args.sites, a.enrichment_workers)  # Fill the cache
+        measure("scrape_website (cached)", lambda: bench_scrape_website(args.sites, a.enrichment_workers))
+        a.http_cache.close()
+        a.http_cache = None
+        measure("download_image", lambda: bench_download_image(args.images, a.enrichment_workers))
+        fill_bench_checkpoint(args.records)
+        for extension in args.export_format:
+            try:
+                measure(f"save_data ({extension})", lambda: bench_save_data(args.records, extension))
+            except (ImportError, RuntimeError) as e:
+                results.append({"benchmark": f"save_data ({extension})", "skipped": f"export dependency missing: {e}"})
+        if args.skip_browser:
+            results.append({"benchmark": "scrape_business", "skipped": "--skip-browser"})
+        else:
+            queries = [(city, category) for city in list(a.cities)[:2] for category in a.categories[:args.queries]]
+            queries = queries[:args.queries] + [(list(a.cities)[0], "Toy library"), (list(a.cities)[0], "Museum")]
+            try:
+                measure("scrape_business", lambda: bench_scrape_business(queries))
+            except Exception as e:
+                results.append({"benchmark": "scrape_business", "skipped": f"browser unavailable: {e}"})
+    finally:
+        os.chdir(cwd)
+        for server in servers:
+            server.shutdown()
+
+    for result in results:
+        if "skipped" in result:
+            print(f"{result['benchmark']:<26} skipped ({result['skipped']})")
+            continue
+        rss = f"{result['rss_peak_mb']:.0f} MB" if result["rss_peak_mb"] is not None else "n/a"
+        python_peak = f"{result['python_peak_mb']:.1f} MB" if result["python_peak_mb"] is not None else "n/a"
+        extra = ", ".join(f"{key}={value:.1f}" if isinstance(value, float) else f"{key}={value}"
+                          for key, value in result.items()
+                          if key not in ("benchmark", "seconds", "python_peak_mb", "rss_peak_mb", "stages"))
+        print(f"{result['benchmark']:<26} {result['seconds']:8.2f}s  python peak {python_peak:>9}  "
+              f"rss peak {rss}  {extra}")
+        for stage, stats in result.get("stages", {}).items():
+            print(f"    {stage:<22} n={stats['count']:<4} mean {stats['mean_ms']:8.1f} ms  p95 {stats['p95_ms']:8.1f} ms")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"run_at": datetime.now().isoformat(timespec="seconds"), "results": results}, f, indent=2)
+    print(f"Scratch files left in {workdir}")
+
+if __name__ == "__main__":
+    main()